@@ -142,6 +142,7 @@ class Config:
 
         # File store options
         self.disableCaching: bool = False
+        self.cacheEvictionPolicy: str = 'lru'
         self.linkImports: bool = True
         self.moveExports: bool = False
 
@@ -331,6 +332,7 @@ class Config:
         set_option("linkImports", bool, default=True)
         set_option("moveExports", bool, default=False)
         set_option("disableCaching", bool, default=False)
+        set_option("cacheEvictionPolicy")
 
         # Autoscaling options
         set_option("provisioner")
@@ -559,6 +561,12 @@ def addOptions(parser: ArgumentParser, config: Optional[Config] = None) -> None:
                                     default=False,
                                     help='Disables caching in the file store. This flag must be set to use '
                                          'a batch system that does not support cleanup, such as Parasol.')
+    file_store_options.add_argument('--cacheEvictionPolicy', dest='cacheEvictionPolicy', choices=['lru', 'sample'],
+                                    default='lru',
+                                    help="How to choose cached files to evict when the cache is full. 'lru' evicts "
+                                         "the least recently used files. 'sample' evicts the least recently used of "
+                                         "a random sample of files, which costs less when very many files are "
+                                         "cached. The default is lru.")
 
     # Auto scaling options
     autoscaling_options = parser.add_argument_group(
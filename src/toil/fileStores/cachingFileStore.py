@@ -12,9 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import errno
-import hashlib
 import logging
 import os
+import random
 import re
 import shutil
 import sqlite3
@@ -22,8 +22,11 @@ import stat
 import tempfile
 import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from typing import Any, Callable, Generator, Optional, Tuple
+from queue import Queue
+from typing import Any, Callable, Generator, Optional, Set, Tuple
 
 from toil.common import cacheDirName, getDirSizeRecursively, getFileSystemSize
 from toil.fileStores import FileID
@@ -34,7 +37,11 @@ from toil.lib.compatibility import deprecated
 from toil.lib.conversions import bytes2human
 from toil.lib.io import atomic_copy, atomic_copyobj, make_public_dir, robust_rmtree
 from toil.lib.retry import ErrorCondition, retry
-from toil.lib.threading import get_process_name, process_name_exists
+from toil.lib.threading import (
+    cpu_count,
+    dead_process_names,
+    get_process_name,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -42,6 +49,37 @@ logger = logging.getLogger(__name__)
 # Use longer timeout to avoid hitting 'database is locked' errors.
 SQLITE_TIMEOUT_SECS = 60.0
 
+# Keep enough prepared statements around that none of the queries we use get
+# evicted from the connection's statement cache and have to be parsed again.
+SQLITE_CACHED_STATEMENTS = 256
+
+# Settings applied to every connection to the cache database. We use a
+# write-ahead log so readers and writers on the node don't block each other,
+# and we only sync at checkpoints, which is still safe against corruption.
+# Temporary tables and indexes are kept in memory, and we allow a bigger page
+# cache (in KiB, when negative).
+# The coordination directory can be a tiny tmpfs (/run/lock is 5 MiB on some
+# distributions), and a checkpoint doesn't shrink the write-ahead log on its
+# own. So we checkpoint every 256 pages (about 1 MiB), and truncate the log
+# back down to 1 MiB (in bytes) after each checkpoint.
+SQLITE_PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-64000',
+    'PRAGMA wal_autocheckpoint=256',
+    'PRAGMA journal_size_limit=1048576'
+]
+
+# Uploads to the job store mostly wait on the network, so we can usefully run
+# more of them at once than we have cores, but we don't want to swamp the job
+# store either.
+MAX_UPLOAD_THREADS = 8
+
+# Deletes from the job store are small requests that mostly wait on the
+# network too, so we can run a few more of those at once.
+MAX_DELETE_THREADS = 16
+
 
 class CacheError(Exception):
     """
@@ -111,7 +149,8 @@ class CachingFileStore(AbstractFileStore):
     files contains one entry for each file in the cache. Each entry knows the
     path to its data on disk. It also knows its global file ID, its state, and
     its owning worker PID. If the owning worker dies, another worker will pick
-    it up. It also knows its size.
+    it up. It also knows its size, and when a reference to it was last made,
+    so that the least recently used files can be evicted first.
 
     File states are:
 
@@ -127,8 +166,9 @@ class CachingFileStore(AbstractFileStore):
 
     - "uploadable": stored in the cache and ready to be written to the job
       store by a non-null owner. Transitions to "uploading" when a (thread of)
-      the owning worker process picks it up and begins uploading it, to free
-      cache space or to commit a completed job. If the worker dies, goes to
+      the owning worker process picks it up and begins uploading it, in the
+      background after it is written, to free cache space, or to commit a
+      completed job. If the worker dies, goes to
       state "cached", because it may have outstanding immutable references from
       the dead-but-not-cleaned-up job that was going to write it.
 
@@ -168,10 +208,72 @@ class CachingFileStore(AbstractFileStore):
     references until the null-worker jobs are gone.
 
     properties contains key, value pairs for tracking total space available,
-    and whether caching is free for this run.
+    and whether caching is free for this run. It also holds running totals of
+    the bytes used by cached files, by job disk requirements, and by files
+    with immutable references, which triggers on the other tables keep up to
+    date.
 
     """
 
+    # The queries we run most often, kept in one place so that every use hits
+    # the same compiled statement in the connection's statement cache.
+    _CACHE_AVAILABLE_QUERY = """
+        SELECT (
+            (SELECT value FROM properties WHERE name = 'maxSpace') -
+            (SELECT value FROM properties WHERE name = 'cachedBytes') -
+            ((SELECT value FROM properties WHERE name = 'jobDiskBytes') -
+            (SELECT value FROM properties WHERE name = 'immutableRefBytes'))
+        ) as result
+    """
+    _CACHE_EXTRA_JOB_SPACE_QUERY = """
+        SELECT (
+            (SELECT value FROM properties WHERE name = 'jobDiskBytes') -
+            (SELECT value FROM properties WHERE name = 'immutableRefBytes')
+        ) as result
+    """
+    _SPACE_USABLE_FOR_JOBS_QUERY = """
+        SELECT (
+            (SELECT value FROM properties WHERE name = 'maxSpace') -
+            (SELECT value FROM properties WHERE name = 'jobDiskBytes')
+        ) as result
+    """
+    _PROPERTY_QUERY = 'SELECT value FROM properties WHERE name = ?'
+    _FILE_IS_CACHED_QUERY = 'SELECT COUNT(*) FROM files WHERE id = ? AND (state = ? OR state = ? OR state = ?)'
+    _FILE_PATH_QUERY = 'SELECT path FROM files WHERE id = ?'
+    _CLAIM_DOWNLOAD_SQL = 'INSERT OR IGNORE INTO files (id, path, size, state, owner) VALUES (?, ?, ?, ?, ?)'
+    _ADD_REF_SQL = 'INSERT INTO refs VALUES (?, ?, ?, ?)'
+    _ADD_REF_IF_READABLE_SQL = 'INSERT INTO refs SELECT ?, id, ?, ? FROM files WHERE id = ? AND (state = ? OR state = ? OR state = ?)'
+    _ADD_REF_IF_DOWNLOADING_SQL = 'INSERT INTO refs SELECT ?, id, ?, ? FROM files WHERE id = ? AND state = ? AND owner = ?'
+    _SET_REF_STATE_SQL = 'UPDATE refs SET state = ? WHERE path = ? AND file_id = ?'
+    _RELEASE_FILE_SQL = 'UPDATE files SET state = ?, owner = NULL WHERE id = ?'
+    _CHANGE_FILE_STATE_SQL = 'UPDATE files SET state = ? WHERE id = ? AND state = ?'
+    _DROP_REF_SQL = 'DELETE FROM refs WHERE path = ? AND file_id = ?'
+    # Eviction candidates are cached files with no non-mutable references.
+    # Normally we take the least recently used ones, as many as we need.
+    _LRU_EVICTION_QUERY = """
+        SELECT files.id, files.size FROM files WHERE files.state = 'cached' AND NOT EXISTS (
+            SELECT NULL FROM refs WHERE refs.file_id = files.id AND refs.state != 'mutable'
+        ) ORDER BY files.last_access LIMIT ?
+    """
+    # Or we can take a sample of candidates, starting from a random point in
+    # the table (given as a fraction of the way through it), and take the
+    # least recently used of those. That costs the same however big the cache
+    # gets. The + keeps SQLite from scanning all the cached files through the
+    # state index instead of walking by rowid.
+    _SAMPLE_EVICTION_QUERY = """
+        SELECT id, size FROM (
+            SELECT files.id, files.size, files.last_access FROM files
+            WHERE files.rowid >= (SELECT CAST(? * (MAX(rowid) + 1) AS INTEGER) FROM files)
+            AND +files.state = 'cached' AND NOT EXISTS (
+                SELECT NULL FROM refs WHERE refs.file_id = files.id AND refs.state != 'mutable'
+            ) ORDER BY files.rowid LIMIT ?
+        ) ORDER BY last_access LIMIT 1
+    """
+    # How many candidates to look at when sampling for eviction.
+    _EVICTION_SAMPLE_SIZE = 32
+    # How many files to evict at most in one go.
+    _EVICTION_BATCH_SIZE = 32
+
     def __init__(
         self,
         jobStore: AbstractJobStore,
@@ -192,13 +294,23 @@ class CachingFileStore(AbstractFileStore):
         # otherwise progress, how long in seconds should we wait between
         # polling attempts?  Our mechanism for polling involves an exclusive
         # lock on the database and conditional writes, so this should be high
-        # enough that everyone isn't constantly contending for the lock.
+        # enough that everyone isn't constantly contending for the lock. We
+        # wake up early if someone else commits a change to the database, so
+        # this mostly matters for noticing workers that died.
         self.contentionBackoff = 15
 
+        # How should we pick files to evict from the cache? 'lru' evicts the
+        # least recently used file, and 'sample' evicts the least recently used
+        # of a random sample of files, which is cheaper for very large caches.
+        self.evictionPolicy = self.jobStore.config.cacheEvictionPolicy
+
         # Variables related to caching
         # Decide where the cache directory will be. We put it in the local
         # workflow directory.
         self.localCacheDir = os.path.join(self.workflow_dir, cacheDirName(self.jobStore.config.workflowID))
+        # Cache paths are just names in that directory, so work out the part
+        # they all start with once.
+        self._cachePathPrefix = os.path.join(self.localCacheDir, '')
 
         # Since each worker has it's own unique CachingFileStore instance, and only one Job can run
         # at a time on a worker, we can track some stuff about the running job in ourselves.
@@ -212,8 +324,10 @@ class CachingFileStore(AbstractFileStore):
         # We need to track what attempt of the workflow we are, to prevent crosstalk between attempts' caches.
         self.workflowAttemptNumber = self.jobStore.config.workflowAttemptNumber
 
-        # Make sure the cache directory exists
-        os.makedirs(self.localCacheDir, exist_ok=True)
+        # Make sure the cache directory exists. Usually an earlier job on the
+        # node has made it already.
+        if not os.path.isdir(self.localCacheDir):
+            os.makedirs(self.localCacheDir, exist_ok=True)
 
         # Connect to the cache database in there, or create it if not present.
         # We name it by workflow attempt number in case a previous attempt of
@@ -222,23 +336,37 @@ class CachingFileStore(AbstractFileStore):
         # already been created.
         self.dbPath = os.path.join(self.coordination_dir, f'cache-{self.workflowAttemptNumber}.db')
         # We need to hold onto both a connection (to commit) and a cursor (to actually use the database)
-        self.con = sqlite3.connect(self.dbPath, timeout=SQLITE_TIMEOUT_SECS)
+        self.con = self._connectToDatabase(self.dbPath)
         self.cur = self.con.cursor()
 
-        # Note that sqlite3 automatically starts a transaction when we go to
-        # modify the database.
-        # To finish this transaction and let other people read our writes (or
-        # write themselves), we need to COMMIT after every coherent set of
-        # writes.
+        # Note that we don't use sqlite3's automatic transactions. All our
+        # writes go through _write, which runs each coherent set of writes in
+        # its own transaction and commits it, letting other people read our
+        # writes (or write themselves).
 
-        # Set up the tables
-        self._ensureTables(self.con)
+        # See if the first worker on the node has already set everything up.
+        # The maxSpace property is written last, so if it is there the tables
+        # are too. If the tables aren't there, the query fails.
+        try:
+            self.cur.execute('SELECT COUNT(*) FROM properties WHERE name = ?', ('maxSpace',))
+            cacheInitialized = self.cur.fetchone()[0] > 0
+        except sqlite3.OperationalError:
+            cacheInitialized = False
+
+        if not cacheInitialized:
+            # Set up the tables
+            self._ensureTables(self.con)
 
-        # Initialize the space accounting properties
-        freeSpace, _ = getFileSystemSize(self.localCacheDir)
-        self._write([('INSERT OR IGNORE INTO properties VALUES (?, ?)', ('maxSpace', freeSpace))])
+            # Initialize the space accounting properties
+            freeSpace, _ = getFileSystemSize(self.localCacheDir)
+            self._write([('INSERT OR IGNORE INTO properties VALUES (?, ?)', ('maxSpace', freeSpace))])
 
-        # Space used by caching and by jobs is accounted with queries
+        # Space used by caching and by jobs is accounted with running totals
+        # kept by the database.
+
+        # Whether caching is free can't change once it is recorded in the
+        # database, so we remember it after the first time we look it up.
+        self._cachingIsFree: Optional[bool] = None
 
         # We maintain an asynchronous upload thread, which gets kicked off when
         # we commit the job's completion. It will be None until then. When it
@@ -250,6 +378,20 @@ class CachingFileStore(AbstractFileStore):
         # time.
         self.commitThread = None
 
+        # Files we link into the cache also get uploaded to the job store in
+        # the background as soon as they are written, by a thread with its own
+        # database connection. It is started when the first file needs
+        # uploading, and stopped before the job is committed. It claims files
+        # the same way as everyone else, so anything it doesn't get to is
+        # uploaded at commit time as usual. If the thread dies, we keep what
+        # killed it to raise when we stop it, and the file it was in the middle
+        # of, so the commit can take that file back.
+        self._uploadQueue: Optional['Queue[Optional[Tuple[str, str]]]'] = None
+        self._uploadThread: Optional[threading.Thread] = None
+        self._uploadInFlight: Optional[str] = None
+        self._uploadError: Optional[Exception] = None
+        self._abandonedUploads: Set[str] = set()
+
 
     @staticmethod
     @retry(infinite_retries=True,
@@ -269,7 +411,9 @@ class CachingFileStore(AbstractFileStore):
         to substitute), or bare sql strings.
 
         All operations are executed in a single transaction, which is
-        committed.
+        committed. The transaction takes the write lock up front, so we wait
+        for it (or retry) before doing any work, instead of failing to
+        upgrade a read lock halfway through.
 
         :param sqlite3.Connection con: Connection to the cache database.
         :param sqlite3.Cursor cur: Cursor in the cache database.
@@ -278,6 +422,7 @@ class CachingFileStore(AbstractFileStore):
         :rtype: int
         """
         try:
+            cur.execute('BEGIN IMMEDIATE')
             for item in operations:
                 if not isinstance(item, tuple):
                     # Must be a single SQL string. Wrap it.
@@ -290,6 +435,7 @@ class CachingFileStore(AbstractFileStore):
                     args = item[1]
                 # Do it
                 cur.execute(command, args)
+            rowcount = cur.rowcount
         except Exception as e:
             logging.error('Error talking to caching database: %s', str(e))
 
@@ -308,7 +454,7 @@ class CachingFileStore(AbstractFileStore):
             # Now commit the transaction.
             con.commit()
 
-        return cur.rowcount
+        return rowcount
 
     def _write(self, operations):
         """
@@ -330,6 +476,48 @@ class CachingFileStore(AbstractFileStore):
 
         return self._staticWrite(self.con, self.cur, operations)
 
+    @staticmethod
+    @retry(infinite_retries=True,
+           errors=[
+                         ErrorCondition(
+                             error=sqlite3.OperationalError,
+                             error_message_must_include='is locked')
+                     ])
+    def _connectToDatabase(dbPath):
+        """
+        Open a connection to the caching database at the given path, and
+        configure it for our access pattern.
+
+        The database is shared between all the workers on the node, so we use
+        write-ahead logging. This lets readers proceed while someone else is
+        writing, and makes commits much cheaper since they no longer need to
+        sync the main database file every time. The journal mode is stored in
+        the database itself, but the other settings need to be applied for each
+        connection.
+
+        The connection is in autocommit mode, so that only writes go through
+        transactions, and those transactions are opened explicitly when
+        writing. Reads don't start transactions that hold on to a snapshot of
+        the database until the next commit.
+
+        If we can't get an SQLite lock to switch the journal mode, retry with
+        some backoff until we can.
+
+        :param str dbPath: Path to the cache database.
+        :rtype: sqlite3.Connection
+        """
+
+        con = sqlite3.connect(dbPath, timeout=SQLITE_TIMEOUT_SECS, isolation_level=None,
+                              cached_statements=SQLITE_CACHED_STATEMENTS)
+        try:
+            for pragma in SQLITE_PRAGMAS:
+                con.execute(pragma)
+        except:
+            # Don't leak the connection if we have to retry.
+            con.close()
+            raise
+        return con
+
     @classmethod
     def _ensureTables(cls, con):
         """
@@ -347,7 +535,8 @@ class CachingFileStore(AbstractFileStore):
                 path TEXT UNIQUE NOT NULL,
                 size INT NOT NULL,
                 state TEXT NOT NULL,
-                owner TEXT
+                owner TEXT,
+                last_access REAL NOT NULL DEFAULT (julianday('now'))
             )
         """, """
             CREATE TABLE IF NOT EXISTS refs (
@@ -369,6 +558,85 @@ class CachingFileStore(AbstractFileStore):
                 name TEXT NOT NULL PRIMARY KEY,
                 value INT NOT NULL
             )
+        """,
+        # Index the columns we use to join references to files, to find a
+        # job's references to a file, to look for files in a given state (like
+        # eviction candidates), and to find the files a given worker owns.
+        # Otherwise all the space accounting and eviction queries have to scan
+        # whole tables.
+        'CREATE INDEX IF NOT EXISTS refs_file_state ON refs (file_id, state)',
+        'CREATE INDEX IF NOT EXISTS refs_file_job ON refs (file_id, job_id)',
+        'CREATE INDEX IF NOT EXISTS files_state_owner ON files (state, owner)',
+        'CREATE INDEX IF NOT EXISTS files_owner_state ON files (owner, state)',
+        # Eviction goes through cached files from least to most recently used.
+        'CREATE INDEX IF NOT EXISTS files_state_last_access ON files (state, last_access)',
+        # Keep running totals of the bytes of cached files, of job disk
+        # requirements, and of files held by immutable references, so the
+        # space accounting queries don't have to add them up again every
+        # time. Start from whatever is already in the tables.
+        "INSERT OR IGNORE INTO properties SELECT 'cachedBytes', TOTAL(size) FROM files",
+        "INSERT OR IGNORE INTO properties SELECT 'jobDiskBytes', TOTAL(disk) FROM jobs",
+        """
+            INSERT OR IGNORE INTO properties
+            SELECT 'immutableRefBytes', TOTAL(files.size) FROM refs INNER JOIN files ON refs.file_id = files.id
+            WHERE refs.state = 'immutable'
+        """,
+        # Then maintain the totals with triggers whenever the tables change.
+        # A file can come and go while immutable references to it exist, so
+        # files also have to account for their immutable references.
+        """
+            CREATE TRIGGER IF NOT EXISTS files_inserted AFTER INSERT ON files
+            BEGIN
+                UPDATE properties SET value = value + NEW.size WHERE name = 'cachedBytes';
+                UPDATE properties SET value = value + NEW.size * (
+                    SELECT COUNT(*) FROM refs WHERE refs.file_id = NEW.id AND refs.state = 'immutable'
+                ) WHERE name = 'immutableRefBytes';
+            END
+        """, """
+            CREATE TRIGGER IF NOT EXISTS files_deleted AFTER DELETE ON files
+            BEGIN
+                UPDATE properties SET value = value - OLD.size WHERE name = 'cachedBytes';
+                UPDATE properties SET value = value - OLD.size * (
+                    SELECT COUNT(*) FROM refs WHERE refs.file_id = OLD.id AND refs.state = 'immutable'
+                ) WHERE name = 'immutableRefBytes';
+            END
+        """, """
+            CREATE TRIGGER IF NOT EXISTS refs_inserted AFTER INSERT ON refs WHEN NEW.state = 'immutable'
+            BEGIN
+                UPDATE properties SET value = value + COALESCE(
+                    (SELECT size FROM files WHERE files.id = NEW.file_id), 0
+                ) WHERE name = 'immutableRefBytes';
+            END
+        """, """
+            CREATE TRIGGER IF NOT EXISTS refs_touch_file AFTER INSERT ON refs
+            BEGIN
+                UPDATE files SET last_access = julianday('now') WHERE id = NEW.file_id;
+            END
+        """, """
+            CREATE TRIGGER IF NOT EXISTS refs_deleted AFTER DELETE ON refs WHEN OLD.state = 'immutable'
+            BEGIN
+                UPDATE properties SET value = value - COALESCE(
+                    (SELECT size FROM files WHERE files.id = OLD.file_id), 0
+                ) WHERE name = 'immutableRefBytes';
+            END
+        """, """
+            CREATE TRIGGER IF NOT EXISTS refs_updated AFTER UPDATE OF state ON refs
+            WHEN (OLD.state = 'immutable') != (NEW.state = 'immutable')
+            BEGIN
+                UPDATE properties SET value = value + (CASE WHEN NEW.state = 'immutable' THEN 1 ELSE -1 END) * COALESCE(
+                    (SELECT size FROM files WHERE files.id = NEW.file_id), 0
+                ) WHERE name = 'immutableRefBytes';
+            END
+        """, """
+            CREATE TRIGGER IF NOT EXISTS jobs_inserted AFTER INSERT ON jobs
+            BEGIN
+                UPDATE properties SET value = value + NEW.disk WHERE name = 'jobDiskBytes';
+            END
+        """, """
+            CREATE TRIGGER IF NOT EXISTS jobs_deleted AFTER DELETE ON jobs
+            BEGIN
+                UPDATE properties SET value = value - OLD.disk WHERE name = 'jobDiskBytes';
+            END
         """])
 
     # Caching-specific API
@@ -380,7 +648,8 @@ class CachingFileStore(AbstractFileStore):
         If no limit is available, raises an error.
         """
 
-        for row in self.cur.execute('SELECT value FROM properties WHERE name = ?', ('maxSpace',)):
+        row = self.cur.execute(self._PROPERTY_QUERY, ('maxSpace',)).fetchone()
+        if row is not None:
             return row[0]
 
         raise RuntimeError('Unable to retrieve cache limit')
@@ -396,7 +665,8 @@ class CachingFileStore(AbstractFileStore):
         if self.cachingIsFree():
             return 0
 
-        for row in self.cur.execute('SELECT TOTAL(size) FROM files'):
+        row = self.cur.execute(self._PROPERTY_QUERY, ('cachedBytes',)).fetchone()
+        if row is not None:
             return row[0]
 
         raise RuntimeError('Unable to retrieve cache usage')
@@ -413,13 +683,9 @@ class CachingFileStore(AbstractFileStore):
         If no value is available, raises an error.
         """
 
-        # Total up the sizes of all the reads of files and subtract it from the total disk reservation of all jobs
-        for row in self.cur.execute("""
-            SELECT (
-                (SELECT TOTAL(disk) FROM jobs) -
-                (SELECT TOTAL(files.size) FROM refs INNER JOIN files ON refs.file_id = files.id WHERE refs.state == 'immutable')
-            ) as result
-        """):
+        # Take the total size of all the reads of files away from the total disk reservation of all jobs
+        row = self.cur.execute(self._CACHE_EXTRA_JOB_SPACE_QUERY).fetchone()
+        if row is not None:
             return row[0]
 
         raise RuntimeError('Unable to retrieve extra job space')
@@ -439,32 +705,24 @@ class CachingFileStore(AbstractFileStore):
         # aren't being spent by those jobs on immutable references to cached
         # content.
 
-        # Do a little report first
-        for row in self.cur.execute("SELECT value FROM properties WHERE name = 'maxSpace'"):
-            logger.debug('Max space: %d', row[0])
-        for row in self.cur.execute("SELECT TOTAL(size) FROM files"):
-            logger.debug('Total file size: %d', row[0])
-        for row in self.cur.execute("SELECT TOTAL(disk) FROM jobs"):
-            logger.debug('Total job disk requirement size: %d', row[0])
-        for row in self.cur.execute("SELECT TOTAL(files.size) FROM refs INNER JOIN files ON refs.file_id = files.id WHERE refs.state = 'immutable'"):
-            logger.debug('Total immutable reference size: %d', row[0])
+        # We keep running totals of all of these in the properties table.
+
+        if logger.isEnabledFor(logging.DEBUG):
+            # Do a little report first
+            for row in self.cur.execute('SELECT name, value FROM properties'):
+                logger.debug('Cache property %s: %s', row[0], row[1])
 
         if self.cachingIsFree():
             # If caching is free, we just say that all the space is always available.
-            for row in self.cur.execute("SELECT value FROM properties WHERE name = 'maxSpace'"):
+            row = self.cur.execute(self._PROPERTY_QUERY, ('maxSpace',)).fetchone()
+            if row is not None:
                 return row[0]
 
             raise RuntimeError('Unable to retrieve available cache space')
 
 
-        for row in self.cur.execute("""
-            SELECT (
-                (SELECT value FROM properties WHERE name = 'maxSpace') -
-                (SELECT TOTAL(size) FROM files) -
-                ((SELECT TOTAL(disk) FROM jobs) -
-                (SELECT TOTAL(files.size) FROM refs INNER JOIN files ON refs.file_id = files.id WHERE refs.state = 'immutable'))
-            ) as result
-        """):
+        row = self.cur.execute(self._CACHE_AVAILABLE_QUERY).fetchone()
+        if row is not None:
             return row[0]
 
         raise RuntimeError('Unable to retrieve available cache space')
@@ -477,12 +735,8 @@ class CachingFileStore(AbstractFileStore):
         If not retrievable, raises an error.
         """
 
-        for row in self.cur.execute("""
-            SELECT (
-                (SELECT value FROM properties WHERE name = 'maxSpace') -
-                (SELECT TOTAL(disk) FROM jobs)
-            ) as result
-        """):
+        row = self.cur.execute(self._SPACE_USABLE_FOR_JOBS_QUERY).fetchone()
+        if row is not None:
             return row[0]
 
         raise RuntimeError('Unable to retrieve usabel space for jobs')
@@ -506,8 +760,9 @@ class CachingFileStore(AbstractFileStore):
             logger.debug('Ref record: %s', str(row))
 
 
-        for row in self.cur.execute('SELECT TOTAL(files.size) FROM refs INNER JOIN files ON refs.file_id = files.id WHERE refs.job_id = ? AND refs.state != ?',
-            (self.jobID, 'mutable')):
+        row = self.cur.execute('SELECT TOTAL(files.size) FROM refs INNER JOIN files ON refs.file_id = files.id WHERE refs.job_id = ? AND refs.state != ?',
+            (self.jobID, 'mutable')).fetchone()
+        if row is not None:
             # Sum up all the sizes of our referenced files, then subtract that from how much we came in with
             return self.jobDiskBytes - row[0]
 
@@ -529,9 +784,8 @@ class CachingFileStore(AbstractFileStore):
         file you need to do it in a transaction.
         """
 
-        for row in self.cur.execute('SELECT COUNT(*) FROM files WHERE id = ? AND (state = ? OR state = ? OR state = ?)',
-            (fileID, 'cached', 'uploadable', 'uploading')):
-
+        row = self.cur.execute(self._FILE_IS_CACHED_QUERY, (fileID, 'cached', 'uploadable', 'uploading')).fetchone()
+        if row is not None:
             return row[0] > 0
         return False
 
@@ -542,7 +796,8 @@ class CachingFileStore(AbstractFileStore):
         Counts mutable references too.
         """
 
-        for row in self.cur.execute('SELECT COUNT(*) FROM refs WHERE file_id = ?', (fileID,)):
+        row = self.cur.execute('SELECT COUNT(*) FROM refs WHERE file_id = ?', (fileID,)).fetchone()
+        if row is not None:
             return row[0]
         return 0
 
@@ -555,8 +810,14 @@ class CachingFileStore(AbstractFileStore):
         configurations, most notably the FileJobStore.
         """
 
-        for row in self.cur.execute('SELECT value FROM properties WHERE name = ?', ('freeCaching',)):
-            return row[0] == 1
+        if self._cachingIsFree is not None:
+            # We already know
+            return self._cachingIsFree
+
+        row = self.cur.execute(self._PROPERTY_QUERY, ('freeCaching',)).fetchone()
+        if row is not None:
+            self._cachingIsFree = row[0] == 1
+            return self._cachingIsFree
 
         # Otherwise we need to set it
         from toil.jobStores.fileJobStore import FileJobStore
@@ -591,7 +852,8 @@ class CachingFileStore(AbstractFileStore):
         self._write([('INSERT OR IGNORE INTO properties VALUES (?, ?)', ('freeCaching', free))])
 
         # Return true if we said caching was free
-        return free == 1
+        self._cachingIsFree = free == 1
+        return self._cachingIsFree
 
     # Internal caching logic
     def _getNewCachingPath(self, fileStoreID):
@@ -603,17 +865,11 @@ class CachingFileStore(AbstractFileStore):
         The file will not be created if it does not exist.
         """
 
-        # Hash the file ID
-        hasher = hashlib.sha1()
-        hasher.update(fileStoreID.encode('utf-8'))
-
-        # Get a unique temp file name, including the file ID's hash to make
-        # sure we can never collide even though we are going to remove the
-        # file.
+        # A random UUID is unique enough that we can never collide, and
+        # unlike a temp file it costs no hashing and no file system round
+        # trips to come up with.
         # TODO: use a de-slashed version of the ID instead?
-        handle, path = tempfile.mkstemp(dir=self.localCacheDir, suffix=hasher.hexdigest())
-        os.close(handle)
-        os.unlink(path)
+        path = self._cachePathPrefix + uuid.uuid4().hex
 
         return path
 
@@ -633,16 +889,12 @@ class CachingFileStore(AbstractFileStore):
             owners.append(row[0])
 
         # Work out which of them have died.
-        deadOwners = []
-        for owner in owners:
-            if not process_name_exists(self.coordination_dir, owner):
-                logger.debug('Owner %s is dead', owner)
-                deadOwners.append(owner)
-            else:
-                logger.debug('Owner %s is alive', owner)
+        deadOwners = dead_process_names(self.coordination_dir, owners)
+        logger.debug('Owners %s are dead out of %s', deadOwners, owners)
 
-        for owner in deadOwners:
-            # Try and adopt all the files that any dead owner had
+        if len(deadOwners) > 0:
+            # Try and adopt all the files that any dead owner had, with one
+            # update per state transition covering all the dead owners.
 
             # If they were deleting, we delete.
             # If they were downloading, we delete. Any outstanding references
@@ -658,14 +910,13 @@ class CachingFileStore(AbstractFileStore):
             #
             # TODO: if we ever let other PIDs be responsible for writing our
             # files asynchronously, this will need to change.
-            self._write([('UPDATE files SET owner = ?, state = ? WHERE owner = ? AND state = ?',
-                (me, 'deleting', owner, 'deleting')),
-                ('UPDATE files SET owner = ?, state = ? WHERE owner = ? AND state = ?',
-                (me, 'deleting', owner, 'downloading')),
-                ('UPDATE files SET owner = NULL, state = ? WHERE owner = ? AND (state = ? OR state = ?)',
-                ('cached', owner, 'uploadable', 'uploading'))])
+            placeholders = ', '.join('?' * len(deadOwners))
+            self._write([('UPDATE files SET owner = ?, state = ? WHERE state IN (?, ?) AND owner IN (%s)' % placeholders,
+                (me, 'deleting', 'deleting', 'downloading', *deadOwners)),
+                ('UPDATE files SET owner = NULL, state = ? WHERE state IN (?, ?) AND owner IN (%s)' % placeholders,
+                ('cached', 'uploadable', 'uploading', *deadOwners))])
 
-            logger.debug('Tried to adopt file operations from dead worker %s to ourselves as %s', owner, me)
+            logger.debug('Tried to adopt file operations from dead workers %s to ourselves as %s', deadOwners, me)
 
     @classmethod
     def _executePendingDeletions(cls, coordination_dir, con, cur):
@@ -705,11 +956,15 @@ class CachingFileStore(AbstractFileStore):
             # database.
             deletedFiles.append(fileID)
 
-        for fileID in deletedFiles:
+        if len(deletedFiles) > 0:
             # Drop all the files. They should have stayed in deleting state. We move them from there to not present at all.
             # Also drop their references, if they had any from dead downloaders.
-            cls._staticWrite(con, cur, [('DELETE FROM files WHERE id = ? AND state = ?', (fileID, 'deleting')),
-                ('DELETE FROM refs WHERE file_id = ?', (fileID,))])
+            # Do it all in one transaction, so we only commit once however many files we deleted.
+            operations = []
+            for fileID in deletedFiles:
+                operations.append(('DELETE FROM files WHERE id = ? AND state = ?', (fileID, 'deleting')))
+                operations.append(('DELETE FROM refs WHERE file_id = ?', (fileID,)))
+            cls._staticWrite(con, cur, operations)
 
         return len(deletedFiles)
 
@@ -730,47 +985,162 @@ class CachingFileStore(AbstractFileStore):
         # Work out who we are
         me = get_process_name(self.coordination_dir)
 
-        # Record how many files we upload
-        uploadedCount = 0
-        while True:
-            # Try and find a file we might want to upload
-            fileID = None
-            filePath = None
-            for row in cur.execute('SELECT id, path FROM files WHERE state = ? AND owner = ? LIMIT 1', ('uploadable', me)):
-                fileID = row[0]
-                filePath = row[1]
-
-            if fileID is None:
-                # Nothing else exists to upload
-                break
+        if len(self._abandonedUploads) > 0:
+            # Our background upload thread died while these were claimed for
+            # uploading. Nobody else is going to finish them, so put them back
+            # to be uploaded with everything else.
+            self._staticWrite(con, cur, [('UPDATE files SET state = ? WHERE id = ? AND state = ? AND owner = ?', ('uploadable', fileID, 'uploading', me))
+                                         for fileID in self._abandonedUploads])
+            self._abandonedUploads.clear()
+
+        # Uploads are independent and mostly wait on the network, so we run
+        # them in a pool of threads. Claiming the files to upload stays on
+        # this thread, with its database connection.
+        uploads = {}
+        uploadedIDs = []
+        failedIDs = []
+        firstError = None
+        try:
+            with ThreadPoolExecutor(max_workers=min(2 * cpu_count(), MAX_UPLOAD_THREADS)) as pool:
+                while True:
+                    # Try and find a file we might want to upload
+                    row = cur.execute('SELECT id, path FROM files WHERE state = ? AND owner = ? LIMIT 1', ('uploadable', me)).fetchone()
+                    if row is None:
+                        # Nothing else exists to upload
+                        break
+                    fileID, filePath = row
+
+                    # We need to set it to uploading in a way that we can detect that *we* won the update race instead of anyone else.
+                    rowCount = self._staticWrite(con, cur, [(self._CHANGE_FILE_STATE_SQL, ('uploading', fileID, 'uploadable'))])
+                    if rowCount != 1:
+                        # We didn't manage to update it. Someone else (a running job if
+                        # we are a committing thread, or visa versa) must have grabbed
+                        # it.
+                        logger.debug('Lost race to upload %s', fileID)
+                        # Try again to see if there is something else to grab.
+                        continue
+
+                    # Upload the file
+                    logger.debug('Actually executing upload for file %s', fileID)
+                    uploads[fileID] = pool.submit(self.jobStore.update_file, fileID, filePath)
+        finally:
+            # Leaving the pool waited for all the uploads to finish.
+            for fileID, future in uploads.items():
+                error = future.exception()
+                if error is None:
+                    # Remember it for the total uploaded files value we need to return
+                    uploadedIDs.append(fileID)
+                else:
+                    failedIDs.append(fileID)
+                    if firstError is None:
+                        firstError = error
 
-            # We need to set it to uploading in a way that we can detect that *we* won the update race instead of anyone else.
-            rowCount = self._staticWrite(con, cur, [('UPDATE files SET state = ? WHERE id = ? AND state = ?', ('uploading', fileID, 'uploadable'))])
-            if rowCount != 1:
-                # We didn't manage to update it. Someone else (a running job if
-                # we are a committing thread, or visa versa) must have grabbed
-                # it.
-                logger.debug('Lost race to upload %s', fileID)
-                # Try again to see if there is something else to grab.
-                continue
+            if len(uploads) > 0:
+                # Remember that we uploaded them all in the database, in a
+                # single transaction. Do this even if some uploads failed, so
+                # the files we did upload don't get stuck in uploading state.
+                # We need to set the state of the failed ones back to
+                # 'uploadable' to ensure we can retry properly.
+                self._staticWrite(con, cur, [(self._RELEASE_FILE_SQL, ('cached', fileID))
+                                             for fileID in uploadedIDs] +
+                                            [(self._CHANGE_FILE_STATE_SQL, ('uploadable', fileID, 'uploading'))
+                                             for fileID in failedIDs])
 
-            # Upload the file
-            logger.debug('Actually executing upload for file %s', fileID)
-            try:
-                self.jobStore.update_file(fileID, filePath)
-            except:
-                # We need to set the state back to 'uploadable' in case of any failures to ensure
-                # we can retry properly.
-                self._staticWrite(con, cur, [('UPDATE files SET state = ? WHERE id = ? AND state = ?', ('uploadable', fileID, 'uploading'))])
-                raise
+        if firstError is not None:
+            raise firstError
+
+        return len(uploadedIDs)
+
+    def _queueUpload(self, fileID, filePath):
+        """
+        Have the background upload thread upload the given file from the
+        cache, starting the thread if it isn't running.
+
+        :param str fileID: ID of a file we own in uploadable state.
+        :param str filePath: Path to the file's data in the cache.
+        """
 
-            # Count it for the total uploaded files value we need to return
-            uploadedCount += 1
+        if self._uploadThread is None:
+            self._uploadQueue = Queue()
+            self._uploadThread = threading.Thread(target=self._uploadLoop, args=(self._uploadQueue,), daemon=True)
+            self._uploadThread.start()
+        self._uploadQueue.put((fileID, filePath))
 
-            # Remember that we uploaded it in the database
-            self._staticWrite(con, cur, [('UPDATE files SET state = ?, owner = NULL WHERE id = ?', ('cached', fileID))])
+    def _finishQueuedUploads(self):
+        """
+        Wait for the background upload thread to get through all the files
+        queued for it, and stop it.
+
+        Files it couldn't upload are left for _executePendingUploads to deal
+        with. If the thread itself failed, raises the error that stopped it.
+        """
+
+        if self._uploadThread is not None:
+            # Tell the thread to stop once it gets to the end of the queue.
+            self._uploadQueue.put(None)
+            self._uploadThread.join()
+            self._uploadThread = None
+            self._uploadQueue = None
 
-        return uploadedCount
+        if self._uploadInFlight is not None:
+            # The thread died holding this file in uploading state.
+            self._abandonedUploads.add(self._uploadInFlight)
+            self._uploadInFlight = None
+
+        if self._uploadError is not None:
+            error = self._uploadError
+            self._uploadError = None
+            raise error
+
+    def _uploadLoop(self, uploadQueue):
+        """
+        Run in a thread to upload files from the cache to the job store as they
+        are queued, until a None is queued.
+
+        :param queue.Queue uploadQueue: Queue of (file ID, cache path) tuples.
+        """
+
+        con = None
+        try:
+            # SQLite objects are tied to a thread, so we need our own connection.
+            con = self._connectToDatabase(self.dbPath)
+            cur = con.cursor()
+            while True:
+                item = uploadQueue.get()
+                if item is None:
+                    # No more files are coming.
+                    break
+                fileID, filePath = item
+
+                # Claim the file for uploading, in case something else (like
+                # space being freed up) already got to it.
+                rowCount = self._staticWrite(con, cur, [(self._CHANGE_FILE_STATE_SQL, ('uploading', fileID, 'uploadable'))])
+                if rowCount != 1:
+                    logger.debug('Lost race to upload %s in the background', fileID)
+                    continue
+                self._uploadInFlight = fileID
+
+                logger.debug('Actually executing upload in the background for file %s', fileID)
+                try:
+                    self.jobStore.update_file(fileID, filePath)
+                except Exception:
+                    # Put it back so it gets retried, and the error reported,
+                    # when the job commits.
+                    logger.warning('Could not upload file %s in the background; will retry at commit', fileID, exc_info=True)
+                    self._staticWrite(con, cur, [(self._CHANGE_FILE_STATE_SQL, ('uploadable', fileID, 'uploading'))])
+                else:
+                    # Only mark it cached if nobody decided to delete it while
+                    # we were uploading.
+                    self._staticWrite(con, cur, [('UPDATE files SET state = ?, owner = NULL WHERE id = ? AND state = ?', ('cached', fileID, 'uploading'))])
+                self._uploadInFlight = None
+        except Exception as e:
+            # Something went wrong talking to the database. Stop uploading, and
+            # leave the error for whoever stops us.
+            logger.error('Background upload thread failed: %s', e)
+            self._uploadError = e
+        finally:
+            if con is not None:
+                con.close()
 
     def _allocateSpaceForJob(self, newJobReqs):
         """
@@ -820,12 +1190,12 @@ class CachingFileStore(AbstractFileStore):
 
         :param sqlite3.Connection con: Connection to the cache database.
         :param sqlite3.Cursor cur: Cursor in the cache database.
-        :param str jobID: Hash-based ID of the job being removed. Not a Toil JobStore ID.
+        :param str jobID: Job store ID of the job being removed.
         """
 
         # Get the job's temp dir
-        for row in cur.execute('SELECT tempdir FROM jobs WHERE id = ?', (jobID,)):
-            jobTemp = row[0]
+        row = cur.execute('SELECT tempdir FROM jobs WHERE id = ?', (jobID,)).fetchone()
+        jobTemp = row[0] if row is not None else None
 
         for row in cur.execute('SELECT path FROM refs WHERE job_id = ?', (jobID,)):
             try:
@@ -834,17 +1204,19 @@ class CachingFileStore(AbstractFileStore):
             except OSError:
                 # May not exist
                 pass
-        # And their database entries
-        cls._staticWrite(con, cur, [('DELETE FROM refs WHERE job_id = ?', (jobID,))])
 
-        try:
-            # Delete the job's temp directory to the extent that we can.
-            shutil.rmtree(jobTemp)
-        except OSError:
-            pass
+        if jobTemp is not None:
+            try:
+                # Delete the job's temp directory to the extent that we can.
+                shutil.rmtree(jobTemp)
+            except OSError:
+                pass
 
-        # Strike the job from the database
-        cls._staticWrite(con, cur, [('DELETE FROM jobs WHERE id = ?', (jobID,))])
+        # Strike the references and the job from the database together. If we
+        # die before this, whoever adopts the job will just find nothing left
+        # to delete on disk.
+        cls._staticWrite(con, cur, [('DELETE FROM refs WHERE job_id = ?', (jobID,)),
+                                    ('DELETE FROM jobs WHERE id = ?', (jobID,))])
 
     def _deallocateSpaceForJob(self):
         """
@@ -887,36 +1259,48 @@ class CachingFileStore(AbstractFileStore):
         # evictions before starting more, or we might evict everything as
         # soon as we hit the cache limit.
 
-        # Find something that has no non-mutable references and is not already being deleted.
-        self.cur.execute("""
-            SELECT files.id FROM files WHERE files.state = 'cached' AND NOT EXISTS (
-                SELECT NULL FROM refs WHERE refs.file_id = files.id AND refs.state != 'mutable'
-            ) LIMIT 1
-        """)
-        row = self.cur.fetchone()
-        if row is None:
+        # Find things that have no non-mutable references and are not
+        # already being deleted, according to our eviction policy.
+        fileIDs = []
+        needed = -self.getCacheAvailable()
+        if self.evictionPolicy == 'sample':
+            row = self.cur.execute(self._SAMPLE_EVICTION_QUERY, (random.random(), self._EVICTION_SAMPLE_SIZE)).fetchone()
+            if row is not None:
+                fileIDs.append(row[0])
+                needed -= row[1]
+        if len(fileIDs) == 0 or needed > 0:
+            # Either we want the least recently used things, or our sample
+            # started too late in the table to find anything, or didn't free
+            # up enough space.
+            # Take enough of them to cover what we are short, so we don't have
+            # to come back here for every file.
+            for fileID, size in self.cur.execute(self._LRU_EVICTION_QUERY, (self._EVICTION_BATCH_SIZE,)).fetchall():
+                if fileID in fileIDs:
+                    # Our sample already got this one
+                    continue
+                fileIDs.append(fileID)
+                needed -= size
+                if needed <= 0:
+                    break
+        if len(fileIDs) == 0:
             # Nothing can be evicted by us.
             # Someone else might be in the process of evicting something that will free up space for us too.
             # Or someone mught be uploading something and we have to wait for them to finish before it can be deleted.
             logger.debug('Could not find anything to evict! Cannot free up space!')
             return False
 
-        # Otherwise we found an eviction candidate.
-        fileID = row[0]
-
         # Work out who we are
         me = get_process_name(self.coordination_dir)
 
-        # Try and grab it for deletion, subject to the condition that nothing has started reading it
-        self._write([("""
-            UPDATE files SET owner = ?, state = ? WHERE id = ? AND state = ?
+        # Try and grab them for deletion, subject to the condition that nothing has started reading them
+        evicted = self._write([("""
+            UPDATE files SET owner = ?, state = ? WHERE state = ? AND id IN (%s)
             AND owner IS NULL AND NOT EXISTS (
                 SELECT NULL FROM refs WHERE refs.file_id = files.id AND refs.state != 'mutable'
             )
-            """,
-            (me, 'deleting', fileID, 'cached'))])
-
-        logger.debug('Evicting file %s', fileID)
+            """ % ', '.join('?' * len(fileIDs)),
+            (me, 'deleting', 'cached', *fileIDs))])
+        logger.debug('Evicting %d of files %s', evicted, fileIDs)
 
         # Whether we actually got it or not, try deleting everything we have to delete
         if self._executePendingDeletions(self.coordination_dir, self.con, self.cur) > 0:
@@ -924,6 +1308,35 @@ class CachingFileStore(AbstractFileStore):
             logger.debug('Successfully executed pending deletions to free space')
             return True
 
+    def _waitForDatabaseChange(self, timeout):
+        """
+        Block until another connection commits a change to the cache
+        database, or until the timeout expires.
+
+        Polls SQLite's data version, which only changes when someone else
+        commits, and which is cheap to read. We start polling often and back
+        off, so we wake up promptly when another worker uploads or deletes
+        something, without spinning on the database.
+
+        :param float timeout: Maximum number of seconds to wait.
+        :return: True if the database changed, and False if we timed out.
+        :rtype: bool
+        """
+
+        deadline = time.time() + timeout
+        self.cur.execute('PRAGMA data_version')
+        startVersion = self.cur.fetchone()[0]
+        delay = 0.01
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(delay, remaining))
+            self.cur.execute('PRAGMA data_version')
+            if self.cur.fetchone()[0] != startVersion:
+                return True
+            delay = min(delay * 2, 0.1)
+
     def _freeUpSpace(self):
         """
         If disk space is overcomitted, block and evict eligible things from the
@@ -932,9 +1345,10 @@ class CachingFileStore(AbstractFileStore):
 
         availableSpace = self.getCacheAvailable()
 
-        # Track how long we are willing to wait for cache space to free up without making progress evicting things before we give up.
+        # Track how long (in seconds) we are willing to wait for cache space to free up without making progress evicting things before we give up.
         # This is the longes that we will wait for uploads and other deleters.
-        patience = 10
+        patience = 18
+        giveUpTime = time.time() + patience
 
         while availableSpace < 0:
             # While there isn't enough space for the thing we want
@@ -945,7 +1359,7 @@ class CachingFileStore(AbstractFileStore):
 
             if progress:
                 # Reset our patience
-                patience = 10
+                giveUpTime = time.time() + patience
             else:
                 # See if we've been oversubscribed.
                 jobSpace = self.getSpaceUsableForJobs()
@@ -953,13 +1367,12 @@ class CachingFileStore(AbstractFileStore):
                     logger.critical('Jobs on this machine have oversubscribed our total available space (%d bytes)!', jobSpace)
                     raise CacheUnbalancedError
                 else:
-                    patience -= 1
-                    if patience <= 0:
+                    if time.time() >= giveUpTime:
                         logger.critical('Waited implausibly long for active uploads and deletes.')
                         raise CacheUnbalancedError
                     else:
-                        # Wait a bit and come back
-                        time.sleep(2)
+                        # Wait for someone else to change something and come back
+                        self._waitForDatabaseChange(2)
 
         logger.debug('Cache has %d bytes free.', availableSpace)
 
@@ -1040,11 +1453,6 @@ class CachingFileStore(AbstractFileStore):
         # Work out where the file ought to go in the cache
         cachePath = self._getNewCachingPath(fileID)
 
-        # Create a file in uploadable state and a reference, in the same transaction.
-        # Say the reference is an immutable reference
-        self._write([('INSERT INTO files VALUES (?, ?, ?, ?, ?)', (fileID, cachePath, fileSize, 'uploadable', me)),
-            ('INSERT INTO refs VALUES (?, ?, ?, ?)', (absLocalFileName, fileID, creatorID, 'immutable'))])
-
         if absLocalFileName.startswith(self.localTempDir) and not os.path.islink(absLocalFileName):
             # We should link into the cache, because the upload is coming from our local temp dir (and not via a symlink in there)
             try:
@@ -1059,7 +1467,8 @@ class CachingFileStore(AbstractFileStore):
                 logger.debug('Hardlinked file %s into cache at %s; deferring write to job store', localFileName, cachePath)
                 assert not os.path.islink(cachePath), "Symlink %s has invaded cache!" % cachePath
 
-                # Don't do the upload now. Let it be deferred until later (when the job is committing).
+                # Don't do the upload now. Let it happen in the background,
+                # or be deferred until later (when the job is committing).
             except OSError:
                 # We couldn't make the link for some reason
                 linkedToCache = False
@@ -1071,17 +1480,23 @@ class CachingFileStore(AbstractFileStore):
             # files to vanish from our cache.
             linkedToCache = False
 
+        if linkedToCache:
+            # The file is really in the cache now, so record it in uploadable
+            # state with an immutable reference, in the same transaction.
+            self._write([('INSERT INTO files (id, path, size, state, owner) VALUES (?, ?, ?, ?, ?)', (fileID, cachePath, fileSize, 'uploadable', me)),
+                (self._ADD_REF_SQL, (absLocalFileName, fileID, creatorID, 'immutable'))])
 
-        if not linkedToCache:
+            # Start uploading it while the job gets on with its work.
+            self._queueUpload(fileID, cachePath)
+        else:
             # If we can't do the link into the cache and upload from there, we
             # have to just upload right away.  We can't guarantee sufficient
             # space to make a full copy in the cache, if we aren't allowed to
             # take this copy away from the writer.
 
-            # Change the reference to 'mutable', which it will be.
-            # And drop the file altogether.
-            self._write([('UPDATE refs SET state = ? WHERE path = ? AND file_id = ?', ('mutable', absLocalFileName, fileID)),
-                ('DELETE FROM files WHERE id = ?', (fileID,))])
+            # The file never enters the cache; we just hold a mutable
+            # reference to it.
+            self._write([(self._ADD_REF_SQL, (absLocalFileName, fileID, creatorID, 'mutable'))])
 
             # Save the file to the job store right now
             logger.debug('Actually executing upload immediately for file %s', fileID)
@@ -1158,9 +1573,8 @@ class CachingFileStore(AbstractFileStore):
                 # the job store.
 
                 # Find where the file is cached
-                cachedPath = None
-                for row in self.cur.execute('SELECT path FROM files WHERE id = ?', (fileStoreID,)):
-                    cachedPath = row[0]
+                row = self.cur.execute(self._FILE_PATH_QUERY, (fileStoreID,)).fetchone()
+                cachedPath = row[0] if row is not None else None
 
                 if cachedPath is None:
                     raise RuntimeError('File %s went away while we had a reference to it!' % fileStoreID)
@@ -1172,7 +1586,7 @@ class CachingFileStore(AbstractFileStore):
                 atomic_copy(cachedPath, ref_path)
 
                 # Change the reference to mutable so it sticks around
-                self._write([('UPDATE refs SET state = ? WHERE path = ? and file_id = ?',
+                self._write([(self._SET_REF_STATE_SQL,
                              ('mutable', ref_path, fileStoreID))])
             else:
                 # File is not being uploaded currently.
@@ -1183,7 +1597,7 @@ class CachingFileStore(AbstractFileStore):
 
                 # Create a 'mutable' reference (even if we end up with a link)
                 # so we can see this file in deleteLocalFile.
-                self._write([('INSERT INTO refs VALUES (?, ?, ?, ?)',
+                self._write([(self._ADD_REF_SQL,
                     (localFilePath, fileStoreID, readerID, 'mutable'))])
 
                 if self.forceDownloadDelay is not None:
@@ -1241,16 +1655,22 @@ class CachingFileStore(AbstractFileStore):
         # Work out where to cache the file if it isn't cached already
         cachedPath = self._getNewCachingPath(fileStoreID)
 
+        # Work out what we will ask for each time around the loop. Getting the
+        # size may mean asking the job store, so only do it once.
+        claimArgs = (fileStoreID, cachedPath, self.getGlobalFileSize(fileStoreID), 'downloading', me)
+        referenceArgs = (localFilePath, readerID, 'copying', fileStoreID, 'cached', 'uploadable', 'uploading')
+
+        # When should we next look for dead workers holding us up?
+        nextSweepTime = time.time()
+
         # Start a loop until we can do one of these
         while True:
             # Try and create a downloading entry if no entry exists
             logger.debug('Trying to make file record for id %s', fileStoreID)
-            self._write([('INSERT OR IGNORE INTO files VALUES (?, ?, ?, ?, ?)',
-                (fileStoreID, cachedPath, self.getGlobalFileSize(fileStoreID), 'downloading', me))])
+            createdRecord = self._write([(self._CLAIM_DOWNLOAD_SQL, claimArgs)])
 
-            # See if we won the race
-            self.cur.execute('SELECT COUNT(*) FROM files WHERE id = ? AND state = ? AND owner = ?', (fileStoreID, 'downloading', me))
-            if self.cur.fetchone()[0] > 0:
+            # See if we won the race: the record is only inserted if it didn't exist
+            if createdRecord > 0:
                 # We are responsible for downloading the file
                 logger.debug('We are now responsible for downloading file %s', fileStoreID)
 
@@ -1267,7 +1687,7 @@ class CachingFileStore(AbstractFileStore):
                 # two readers, one cached copy, and space for two copies total.
 
                 # Make the copying reference
-                self._write([('INSERT INTO refs VALUES (?, ?, ?, ?)',
+                self._write([(self._ADD_REF_SQL,
                     (localFilePath, fileStoreID, readerID, 'copying'))])
 
                 # Fulfill it with a full copy or by giving away the cached copy
@@ -1284,18 +1704,18 @@ class CachingFileStore(AbstractFileStore):
                 # is in 'cached' or 'uploadable' or 'uploading' state.
                 # It might be uploading because *we* are supposed to be uploading it.
                 logger.debug('Trying to make reference to file %s', fileStoreID)
-                self._write([('INSERT INTO refs SELECT ?, id, ?, ? FROM files WHERE id = ? AND (state = ? OR state = ? OR state = ?)',
-                    (localFilePath, readerID, 'copying', fileStoreID, 'cached', 'uploadable', 'uploading'))])
+                gotReference = self._write([(self._ADD_REF_IF_READABLE_SQL, referenceArgs)])
 
                 # See if we got it
-                self.cur.execute('SELECT COUNT(*) FROM refs WHERE path = ? and file_id = ?', (localFilePath, fileStoreID))
-                if self.cur.fetchone()[0] > 0:
+                if gotReference > 0:
                     # The file is cached and we can copy or link it
                     logger.debug('Obtained reference to file %s', fileStoreID)
 
                     # Get the path it is actually at in the cache, instead of where we wanted to put it
-                    for row in self.cur.execute('SELECT path FROM files WHERE id = ?', (fileStoreID,)):
-                        cachedPath = row[0]
+                    row = self.cur.execute(self._FILE_PATH_QUERY, (fileStoreID,)).fetchone()
+                    if row is None:
+                        raise RuntimeError('File %s went away while we had a reference to it!' % fileStoreID)
+                    cachedPath = row[0]
 
 
                     while self.getCacheAvailable() < 0:
@@ -1310,16 +1730,15 @@ class CachingFileStore(AbstractFileStore):
 
                         # See if we have no other references and we can give away the file.
                         # Change it to downloading owned by us if we can grab it.
-                        self._write([("""
-                            UPDATE files SET files.owner = ?, files.state = ? WHERE files.id = ? AND files.state = ?
+                        if self._write([("""
+                            UPDATE files SET owner = ?, state = ? WHERE files.id = ? AND files.state = ?
                             AND files.owner IS NULL AND NOT EXISTS (
                                 SELECT NULL FROM refs WHERE refs.file_id = files.id AND refs.state != 'mutable'
                             )
                             """,
-                            (me, 'downloading', fileStoreID, 'cached'))])
-
-                        if self._giveAwayDownloadingFile(fileStoreID, cachedPath, localFilePath):
-                            # We got ownership of the file and managed to give it away.
+                            (me, 'downloading', fileStoreID, 'cached'))]) > 0:
+                            # We got ownership of the file, so give it away.
+                            self._giveAwayDownloadingFile(fileStoreID, cachedPath, localFilePath)
                             return localFilePath
 
                         # If we don't have space, and we couldn't make space, and we
@@ -1327,7 +1746,7 @@ class CachingFileStore(AbstractFileStore):
                         # need to wait for one of those people with references to the file
                         # to finish and give it up.
                         # TODO: work out if that will never happen somehow.
-                        time.sleep(self.contentionBackoff)
+                        self._waitForDatabaseChange(self.contentionBackoff)
 
                     # OK, now we have space to make a copy.
 
@@ -1339,7 +1758,7 @@ class CachingFileStore(AbstractFileStore):
                     atomic_copy(cachedPath, localFilePath)
 
                     # Change the reference to mutable
-                    self._write([('UPDATE refs SET state = ? WHERE path = ? AND file_id = ?', ('mutable', localFilePath, fileStoreID))])
+                    self._write([(self._SET_REF_STATE_SQL, ('mutable', localFilePath, fileStoreID))])
 
                     # Now we're done
                     return localFilePath
@@ -1353,13 +1772,17 @@ class CachingFileStore(AbstractFileStore):
             # If we didn't get a download or a reference, adopt and do work
             # from dead workers and loop again.
             # We may have to wait for someone else's download or delete to
-            # finish. If they die, we will notice.
-            self._removeDeadJobs(self.coordination_dir, self.con)
-            self._stealWorkFromTheDead()
-            self._executePendingDeletions(self.coordination_dir, self.con, self.cur)
+            # finish. If they die, we will notice. Sweeping for the dead is
+            # expensive, and we wake up whenever anyone changes anything, so
+            # only do it once per contentionBackoff.
+            if time.time() >= nextSweepTime:
+                self._removeDeadJobs(self.coordination_dir, self.con)
+                self._stealWorkFromTheDead()
+                self._executePendingDeletions(self.coordination_dir, self.con, self.cur)
+                nextSweepTime = time.time() + self.contentionBackoff
 
             # Wait for other people's downloads to progress before re-polling.
-            time.sleep(self.contentionBackoff)
+            self._waitForDatabaseChange(self.contentionBackoff)
 
     def _fulfillCopyingReference(self, fileStoreID, cachedPath, localFilePath):
         """
@@ -1379,14 +1802,14 @@ class CachingFileStore(AbstractFileStore):
 
         if self.getCacheAvailable() < 0:
             # No space for the cached copy and this copy. Give this copy away.
-            assert self._giveAwayDownloadingFile(fileStoreID, cachedPath, localFilePath)
+            self._giveAwayDownloadingFile(fileStoreID, cachedPath, localFilePath)
             return
 
         # Otherwise we have space for the cached copy and the user copy.
         # Expose this file as cached so other people can copy off of it too.
 
         # Change state from downloading to cached
-        self._write([('UPDATE files SET state = ?, owner = NULL WHERE id = ?',
+        self._write([(self._RELEASE_FILE_SQL,
             ('cached', fileStoreID))])
 
         if self.forceDownloadDelay is not None:
@@ -1397,7 +1820,7 @@ class CachingFileStore(AbstractFileStore):
         atomic_copy(cachedPath, localFilePath)
 
         # Change our reference to mutable
-        self._write([('UPDATE refs SET state = ? WHERE path = ? AND file_id = ?', ('mutable', localFilePath, fileStoreID))])
+        self._write([(self._SET_REF_STATE_SQL, ('mutable', localFilePath, fileStoreID))])
 
         # Now we're done
         return
@@ -1409,37 +1832,32 @@ class CachingFileStore(AbstractFileStore):
 
         Used when there's no room for both a cached copy of the file and the user's actual mutable copy.
 
-        Returns true if the file was moved, and false if the file was not owned by us in 'downloading' state.
+        The caller must already own the file in 'downloading' state; callers
+        know this from the write that gave them ownership, so we don't check
+        again.
 
         :param toil.fileStores.FileID or str fileStoreID: job store id for the file
         :param str cachedPath: absolute source path in the cache.
         :param str localFilePath: absolute destination path. Already known not to exist.
-        :return: True if the file is successfully moved. False if the file is not owned by us in 'downloading' state.
-        :rtype: bool
         """
 
-        # Work out who we are
-        me = get_process_name(self.coordination_dir)
-
-        # See if we actually own this file and can giove it away
-        self.cur.execute('SELECT COUNT(*) FROM files WHERE id = ? AND state = ? AND owner = ?',
-            (fileStoreID, 'downloading', me))
-        if self.cur.fetchone()[0] > 0:
-            # Now we have exclusive control of the cached copy of the file, so we can give it away.
-
-            # Don't fake a delay here; this should be a rename always.
+        # We have exclusive control of the cached copy of the file, so we can give it away.
 
-            # We are giving it away
-            shutil.move(cachedPath, localFilePath)
-            # Record that.
-            self._write([('UPDATE refs SET state = ? WHERE path = ? AND file_id = ?', ('mutable', localFilePath, fileStoreID)),
-                ('DELETE FROM files WHERE id = ?', (fileStoreID,))])
+        # Don't fake a delay here; this should be a rename always.
 
-            # Now we're done
-            return True
-        else:
-            # We don't own this file in 'downloading' state
-            return False
+        # We are giving it away. The cache and the job's temp dir are
+        # normally on the same file system, so this is just a rename.
+        try:
+            os.replace(cachedPath, localFilePath)
+        except OSError as e:
+            if e.errno == errno.EXDEV:
+                # They aren't, so we need to actually copy the data.
+                shutil.move(cachedPath, localFilePath)
+            else:
+                raise
+        # Record that.
+        self._write([(self._SET_REF_STATE_SQL, ('mutable', localFilePath, fileStoreID)),
+            ('DELETE FROM files WHERE id = ?', (fileStoreID,))])
 
     def _createLinkFromCache(self, cachedPath, localFilePath, symlink=True):
         """
@@ -1495,20 +1913,27 @@ class CachingFileStore(AbstractFileStore):
         # Work out where to cache the file if it isn't cached already
         cachedPath = self._getNewCachingPath(fileStoreID)
 
+        # Work out what we will ask for each time around the loop. Getting the
+        # size may mean asking the job store, so only do it once.
+        claimArgs = (fileStoreID, cachedPath, self.getGlobalFileSize(fileStoreID), 'downloading', me)
+        downloadReferenceArgs = (localFilePath, readerID, 'immutable', fileStoreID, 'downloading', me)
+        referenceArgs = (localFilePath, readerID, 'immutable', fileStoreID, 'cached', 'uploadable', 'uploading')
+
+        # When should we next look for dead workers holding us up?
+        nextSweepTime = time.time()
+
         # Start a loop until we can do one of these
         while True:
             # Try and create a downloading entry if no entry exists.
             # Make sure to create a reference at the same time if it succeeds, to bill it against our job's space.
             # Don't create the mutable reference yet because we might not necessarily be able to clear that space.
             logger.debug('Trying to make file downloading file record and reference for id %s', fileStoreID)
-            self._write([('INSERT OR IGNORE INTO files VALUES (?, ?, ?, ?, ?)',
-                (fileStoreID, cachedPath, self.getGlobalFileSize(fileStoreID), 'downloading', me)),
-                ('INSERT INTO refs SELECT ?, id, ?, ? FROM files WHERE id = ? AND state = ? AND owner = ?',
-                (localFilePath, readerID, 'immutable', fileStoreID, 'downloading', me))])
-
-            # See if we won the race
-            self.cur.execute('SELECT COUNT(*) FROM files WHERE id = ? AND state = ? AND owner = ?', (fileStoreID, 'downloading', me))
-            if self.cur.fetchone()[0] > 0:
+            gotDownloadReference = self._write([(self._CLAIM_DOWNLOAD_SQL, claimArgs),
+                (self._ADD_REF_IF_DOWNLOADING_SQL, downloadReferenceArgs)])
+
+            # See if we won the race: we only get the reference if the file is
+            # ours to download
+            if gotDownloadReference > 0:
                 # We are responsible for downloading the file (and we have the reference)
                 logger.debug('We are now responsible for downloading file %s', fileStoreID)
 
@@ -1524,7 +1949,7 @@ class CachingFileStore(AbstractFileStore):
                     # We made the link!
 
                     # Change file state from downloading to cached so other people can use it
-                    self._write([('UPDATE files SET state = ?, owner = NULL WHERE id = ?',
+                    self._write([(self._RELEASE_FILE_SQL,
                         ('cached', fileStoreID))])
 
                     # Now we're done!
@@ -1533,7 +1958,7 @@ class CachingFileStore(AbstractFileStore):
                     # We could not make a link. We need to make a copy.
 
                     # Change the reference to copying.
-                    self._write([('UPDATE refs SET state = ? WHERE path = ? AND file_id = ?', ('copying', localFilePath, fileStoreID))])
+                    self._write([(self._SET_REF_STATE_SQL, ('copying', localFilePath, fileStoreID))])
 
                     # Fulfill it with a full copy or by giving away the cached copy
                     self._fulfillCopyingReference(fileStoreID, cachedPath, localFilePath)
@@ -1549,18 +1974,18 @@ class CachingFileStore(AbstractFileStore):
                 # is in 'cached' or 'uploadable' or 'uploading' state.
                 # It might be uploading because *we* are supposed to be uploading it.
                 logger.debug('Trying to make reference to file %s', fileStoreID)
-                self._write([('INSERT INTO refs SELECT ?, id, ?, ? FROM files WHERE id = ? AND (state = ? OR state = ? OR state = ?)',
-                    (localFilePath, readerID, 'immutable', fileStoreID, 'cached', 'uploadable', 'uploading'))])
+                gotReference = self._write([(self._ADD_REF_IF_READABLE_SQL, referenceArgs)])
 
                 # See if we got it
-                self.cur.execute('SELECT COUNT(*) FROM refs WHERE path = ? and file_id = ?', (localFilePath, fileStoreID))
-                if self.cur.fetchone()[0] > 0:
+                if gotReference > 0:
                     # The file is cached and we can copy or link it
                     logger.debug('Obtained reference to file %s', fileStoreID)
 
                     # Get the path it is actually at in the cache, instead of where we wanted to put it
-                    for row in self.cur.execute('SELECT path FROM files WHERE id = ?', (fileStoreID,)):
-                        cachedPath = row[0]
+                    row = self.cur.execute(self._FILE_PATH_QUERY, (fileStoreID,)).fetchone()
+                    if row is None:
+                        raise RuntimeError('File %s went away while we had a reference to it!' % fileStoreID)
+                    cachedPath = row[0]
 
                     if self._createLinkFromCache(cachedPath, localFilePath, symlink):
                         # We managed to make the link
@@ -1574,7 +1999,7 @@ class CachingFileStore(AbstractFileStore):
                         # we already have code for that for mutable downloads,
                         # so just clear the reference and download mutably.
 
-                        self._write([('DELETE FROM refs WHERE path = ? AND file_id = ?', (localFilePath, fileStoreID))])
+                        self._write([(self._DROP_REF_SQL, (localFilePath, fileStoreID))])
 
                         return self._readGlobalFileMutablyWithCache(fileStoreID, localFilePath, readerID)
                 else:
@@ -1582,16 +2007,20 @@ class CachingFileStore(AbstractFileStore):
 
                     # If we didn't get a download or a reference, adopt and do work from dead workers and loop again.
                     # We may have to wait for someone else's download or delete to
-                    # finish. If they die, we will notice.
-                    self._removeDeadJobs(self.coordination_dir, self.con)
-                    self._stealWorkFromTheDead()
-                    # We may have acquired ownership of partially-downloaded
-                    # files, now in deleting state, that we need to delete
-                    # before we can download them.
-                    self._executePendingDeletions(self.coordination_dir, self.con, self.cur)
+                    # finish. If they die, we will notice. Sweeping for the
+                    # dead is expensive, and we wake up whenever anyone changes
+                    # anything, so only do it once per contentionBackoff.
+                    if time.time() >= nextSweepTime:
+                        self._removeDeadJobs(self.coordination_dir, self.con)
+                        self._stealWorkFromTheDead()
+                        # We may have acquired ownership of partially-downloaded
+                        # files, now in deleting state, that we need to delete
+                        # before we can download them.
+                        self._executePendingDeletions(self.coordination_dir, self.con, self.cur)
+                        nextSweepTime = time.time() + self.contentionBackoff
 
                     # Wait for other people's downloads to progress.
-                    time.sleep(self.contentionBackoff)
+                    self._waitForDatabaseChange(self.contentionBackoff)
 
     @contextmanager
     def _with_copying_reference_to_upload(self, file_store_id: FileID, reader_id: str, local_file_path: Optional[str] = None) -> Generator:
@@ -1615,14 +2044,9 @@ class CachingFileStore(AbstractFileStore):
             # Generate a file path for the reference if one is not provided.
             local_file_path = self.getLocalTempFileName()
 
-        # Try and make a 'copying' reference to such a file
-        self._write([('INSERT INTO refs SELECT ?, id, ?, ? FROM files WHERE id = ? AND (state = ? OR state = ?)',
-            (local_file_path, reader_id, 'copying', file_store_id, 'uploadable', 'uploading'))])
-
-        # See if we got it
-        have_reference = False
-        for row in self.cur.execute('SELECT COUNT(*) FROM refs WHERE path = ? and file_id = ?', (local_file_path, file_store_id)):
-            have_reference = row[0] > 0
+        # Try and make a 'copying' reference to such a file, and see if we got it
+        have_reference = self._write([('INSERT INTO refs SELECT ?, id, ?, ? FROM files WHERE id = ? AND (state = ? OR state = ?)',
+            (local_file_path, reader_id, 'copying', file_store_id, 'uploadable', 'uploading'))]) > 0
 
         if have_reference:
             try:
@@ -1652,9 +2076,8 @@ class CachingFileStore(AbstractFileStore):
 
                 # The ref file is not actually copied to; find the actual file
                 # in the cache
-                cached_path = None
-                for row in self.cur.execute('SELECT path FROM files WHERE id = ?', (fileStoreID,)):
-                    cached_path = row[0]
+                row = self.cur.execute(self._FILE_PATH_QUERY, (fileStoreID,)).fetchone()
+                cached_path = row[0] if row is not None else None
 
                 if cached_path is None:
                     raise RuntimeError('File %s went away while we had a reference to it!' % fileStoreID)
@@ -1704,9 +2127,11 @@ class CachingFileStore(AbstractFileStore):
             # But if we found a missing local copy, go on to report that instead.
             raise OSError(errno.ENOENT, f"Attempting to delete local copies of a file with none: {fileStoreID}")
 
+        if len(deleted) > 0:
+            # Drop the references, all in one transaction
+            self._write([('DELETE FROM refs WHERE file_id = ? AND job_id = ? AND path = ?', (fileStoreID, jobID, path))
+                         for path in deleted])
         for path in deleted:
-            # Drop the references
-            self._write([('DELETE FROM refs WHERE file_id = ? AND job_id = ? AND path = ?', (fileStoreID, jobID, path))])
             logger.debug('Deleted local file %s for global file %s', path, fileStoreID)
 
         # Now space has been revoked from the cache because that job needs its space back.
@@ -1735,7 +2160,8 @@ class CachingFileStore(AbstractFileStore):
         me = get_process_name(self.coordination_dir)
 
         # Make sure nobody else has references to it
-        for row in self.cur.execute('SELECT job_id FROM refs WHERE file_id = ? AND state != ?', (fileStoreID, 'mutable')):
+        row = self.cur.execute('SELECT job_id FROM refs WHERE file_id = ? AND state != ?', (fileStoreID, 'mutable')).fetchone()
+        if row is not None:
             raise RuntimeError('Deleted file ID {} which is still in use by job {}'.format(fileStoreID, row[0]))
         # TODO: should we just let other jobs and the cache keep the file until
         # it gets evicted, and only delete at the back end?
@@ -1749,8 +2175,8 @@ class CachingFileStore(AbstractFileStore):
         # Add the file to the list of files to be deleted from the job store
         # once the run method completes.
         self.filesToDelete.add(str(fileStoreID))
-        self.logToMaster('Added file with ID \'%s\' to the list of files to be' % fileStoreID +
-                         ' globally deleted.', level=logging.DEBUG)
+        self.logToMaster(f"Added file with ID '{fileStoreID}' to the list of files to be globally deleted.",
+                         level=logging.DEBUG)
 
     @deprecated(new_function_name='export_file')
     def exportFile(self, jobStoreFileID: FileID, dstUrl: str) -> None:
@@ -1765,7 +2191,11 @@ class CachingFileStore(AbstractFileStore):
         # until they are done.
 
         # For safety and simplicity, we just execute all pending uploads now.
-        self._executePendingUploads(self.con, self.cur)
+        try:
+            self._finishQueuedUploads()
+        finally:
+            # Even if the background uploads failed, upload what they left.
+            self._executePendingUploads(self.con, self.cur)
 
         # Then we let the job store export. TODO: let the export come from the
         # cache? How would we write the URL?
@@ -1810,15 +2240,27 @@ class CachingFileStore(AbstractFileStore):
             # Reconnect to the database from this thread. The main thread can
             # keep using self.con and self.cur. We need to do this because
             # SQLite objects are tied to a thread.
-            con = sqlite3.connect(self.dbPath, timeout=SQLITE_TIMEOUT_SECS)
-            cur = con.cursor()
+            con = self._connectToDatabase(self.dbPath)
+            try:
+                cur = con.cursor()
 
-            logger.debug('Committing file uploads asynchronously')
+                logger.debug('Committing file uploads asynchronously')
 
-            # Finish all uploads
-            self._executePendingUploads(con, cur)
-            # Finish all deletions out of the cache (not from the job store)
-            self._executePendingDeletions(self.coordination_dir, con, cur)
+                # Finish all uploads
+                try:
+                    self._finishQueuedUploads()
+                finally:
+                    # Even if the background uploads failed, upload what they
+                    # left, so nothing is stuck half-uploaded.
+                    self._executePendingUploads(con, cur)
+                # Finish all deletions out of the cache (not from the job store)
+                self._executePendingDeletions(self.coordination_dir, con, cur)
+            finally:
+                # We are done with the database from this thread. Close the
+                # connection now rather than leaving it to the garbage
+                # collector, so that the last connection to close can
+                # checkpoint and remove the write-ahead log.
+                con.close()
 
             if jobState:
                 # Do all the things that make this job not redoable
@@ -1830,10 +2272,15 @@ class CachingFileStore(AbstractFileStore):
                 self.jobDesc.filesToDelete = list(self.filesToDelete)
                 # Complete the job
                 self.jobStore.update_job(self.jobDesc)
-                # Delete any remnant jobs
-                list(map(self.jobStore.delete_job, self.jobsToDelete))
-                # Delete any remnant files
-                list(map(self.jobStore.delete_file, self.filesToDelete))
+                # Delete any remnant jobs, and then any remnant files, several
+                # at a time. The jobs have to go first, because deleting a job
+                # can delete files that belong to it out from under a file
+                # delete.
+                for function, toDelete in [(self.jobStore.delete_job, self.jobsToDelete),
+                                           (self.jobStore.delete_file, self.filesToDelete)]:
+                    if len(toDelete) > 0:
+                        with ThreadPoolExecutor(max_workers=min(len(toDelete), MAX_DELETE_THREADS)) as pool:
+                            list(pool.map(function, toDelete))
                 # Remove the files to delete list, having successfully removed the files
                 if len(self.filesToDelete) > 0:
                     self.jobDesc.filesToDelete = []
@@ -1901,7 +2348,7 @@ class CachingFileStore(AbstractFileStore):
                 if os.path.exists(dbPath):
                     try:
                         # The database exists, see if we can open it
-                        con = sqlite3.connect(dbPath, timeout=SQLITE_TIMEOUT_SECS)
+                        con = cls._connectToDatabase(dbPath)
                     except:
                         # Probably someone deleted it.
                         pass
@@ -1918,14 +2365,31 @@ class CachingFileStore(AbstractFileStore):
 
                         con.close()
             else:
-                logger.debug('No caching database found in %s', dir_)
+                logger.debug('No caching database found in %s', coordination_dir)
 
             # Whether or not we found a database, we need to clean up the cache
-            # directory. Delete everything cached.
+            # directory. Delete everything cached. The cached files all sit
+            # directly in the cache directory, so unlink those several at a
+            # time, and then sweep up anything else that is left.
+            try:
+                cachedFiles = [entry.path for entry in os.scandir(cache_dir) if entry.is_file(follow_symlinks=False)]
+            except FileNotFoundError:
+                # Someone else got to it first
+                cachedFiles = []
+            if len(cachedFiles) > 0:
+                def unlinkCachedFile(path):
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        # Someone else is cleaning up too
+                        pass
+                with ThreadPoolExecutor(max_workers=min(len(cachedFiles), MAX_DELETE_THREADS)) as pool:
+                    list(pool.map(unlinkCachedFile, cachedFiles))
             robust_rmtree(cache_dir)
             for filename in all_db_files:
-                # And delete everything related to the caching database
-                robust_rmtree(filename)
+                # And delete everything related to the caching database,
+                # including the write-ahead log and shared memory files.
+                robust_rmtree(os.path.join(coordination_dir, filename))
                 
     def __del__(self):
         """
@@ -1957,17 +2421,13 @@ class CachingFileStore(AbstractFileStore):
             workers.append(row[0])
 
         # Work out which of them are not currently running.
-        # TODO: account for PID reuse somehow.
-        deadWorkers = []
-        for worker in workers:
-            if not process_name_exists(coordination_dir, worker):
-                deadWorkers.append(worker)
+        deadWorkers = dead_process_names(coordination_dir, workers)
 
         # Now we know which workers are dead.
-        # Clear them off of the jobs they had.
-        for deadWorker in deadWorkers:
-            cls._staticWrite(con, cur, [('UPDATE jobs SET worker = NULL WHERE worker = ?', (deadWorker,))])
+        # Clear them off of the jobs they had, all at once.
         if len(deadWorkers) > 0:
+            cls._staticWrite(con, cur, [('UPDATE jobs SET worker = NULL WHERE worker IN (%s)' % ', '.join('?' * len(deadWorkers)),
+                                         tuple(deadWorkers))])
             logger.debug('Reaped %d dead workers', len(deadWorkers))
 
         while True:
@@ -1981,13 +2441,8 @@ class CachingFileStore(AbstractFileStore):
 
             jobID = row[0]
 
-            # Try to own this job
-            cls._staticWrite(con, cur, [('UPDATE jobs SET worker = ? WHERE id = ? AND worker IS NULL', (me, jobID))])
-
-            # See if we won the race
-            cur.execute('SELECT id, tempdir FROM jobs WHERE id = ? AND worker = ?', (jobID, me))
-            row = cur.fetchone()
-            if row is None:
+            # Try to own this job. If we changed a row, we won the race.
+            if cls._staticWrite(con, cur, [('UPDATE jobs SET worker = ? WHERE id = ? AND worker IS NULL', (me, jobID))]) == 0:
                 # We didn't win the race. Try another one.
                 continue
 
@@ -1,7 +1,9 @@
+import fcntl
 import logging
 import os
 import shutil
 import stat
+import sys
 import uuid
 from contextlib import contextmanager
 from io import BytesIO
@@ -104,12 +106,39 @@ def AtomicFileCreate(final_path: str, keep: bool = False) -> Iterator[str]:
         raise
 
 
+# The Linux ioctl for making dest a copy-on-write clone of src, from linux/fs.h.
+FICLONE = 0x40049409
+
+
+def try_reflink(src_path: str, dest_path: str) -> bool:
+    """
+    Try to make dest_path a copy-on-write clone of src_path, which copies no
+    data. This only works on Linux, for file systems that support it (like XFS
+    and Btrfs), and when both files are on the same file system.
+
+    :return: True if dest_path is now a clone of src_path, and False if no
+             clone could be made, in which case dest_path may exist but is
+             empty.
+    """
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        with open(src_path, 'rb') as src_fh, open(dest_path, 'wb') as dest_fh:
+            fcntl.ioctl(dest_fh.fileno(), FICLONE, src_fh.fileno())
+        return True
+    except OSError:
+        # Unsupported file system, different file systems, or something else
+        # we can fall back from by copying.
+        return False
+
+
 def atomic_copy(src_path: str, dest_path: str, executable: Optional[bool] = None) -> None:
     """Copy a file using posix atomic creations semantics."""
     if executable is None:
         executable = os.stat(src_path).st_mode & stat.S_IXUSR != 0
     with AtomicFileCreate(dest_path) as dest_path_tmp:
-        shutil.copyfile(src_path, dest_path_tmp)
+        if not try_reflink(src_path, dest_path_tmp):
+            shutil.copyfile(src_path, dest_path_tmp)
         if executable:
             os.chmod(dest_path_tmp, os.stat(dest_path_tmp).st_mode | stat.S_IXUSR)
 
@@ -25,7 +25,7 @@ import tempfile
 import threading
 import traceback
 from contextlib import contextmanager
-from typing import Any, Dict, Iterator, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional
 
 import psutil  # type: ignore
 
@@ -275,12 +275,29 @@ def process_name_exists(base_dir: str, name: str) -> bool:
         # If the file is gone, the process can't exist.
         return False
 
+    return _process_name_file_held(nameFileName)
+
+def _process_name_file_held(nameFileName: str) -> bool:
+    """
+    Return true if the process name file at the given path, which we think
+    exists, is still locked by its living process, and false otherwise.
+
+    If nobody holds the file, removes it.
+
+    :param str nameFileName: Path to the process name file.
+    :return: True if the named process is still alive, and False otherwise.
+    :rtype: bool
+    """
 
     nameFD = None
     try:
-        # Otherwise see if we can lock it shared, for which we need an FD, but
-        # only for reading.
-        nameFD = os.open(nameFileName, os.O_RDONLY)
+        # See if we can lock it shared, for which we need an FD, but only for
+        # reading.
+        try:
+            nameFD = os.open(nameFileName, os.O_RDONLY)
+        except FileNotFoundError:
+            # It went away, so the process can't exist.
+            return False
         try:
             fcntl.lockf(nameFD, fcntl.LOCK_SH | fcntl.LOCK_NB)
         except OSError as e:
@@ -304,6 +321,43 @@ def process_name_exists(base_dir: str, name: str) -> bool:
             except:
                 pass
 
+def dead_process_names(base_dir: str, names: Iterable[str]) -> List[str]:
+    """
+    Return the names (from process_name) of the given processes that are no longer alive.
+
+    Lists the base directory once, so that names whose files are already gone
+    can be declared dead without polling them one at a time. The remaining
+    names are polled by trying to lock their files.
+
+    :param str base_dir: Base directory to work in. Defines the shared namespace.
+    :param names: Processes' names to poll
+    :return: The names of the processes that are not alive, in the order given.
+    """
+
+    global current_process_name_lock
+    global current_process_name_for
+
+    names = list(names)
+    if len(names) == 0:
+        # Nobody to poll, so don't bother looking at the directory.
+        return []
+
+    with current_process_name_lock:
+        # We are always alive, even if our file went away.
+        our_name = current_process_name_for.get(base_dir, None)
+
+    # See what name files exist, all at once.
+    present = set(os.listdir(base_dir))
+
+    dead = []
+    for name in names:
+        if name == our_name:
+            continue
+        if name not in present or not _process_name_file_held(os.path.join(base_dir, name)):
+            # Either the file is gone, or it is there but nobody holds it.
+            dead.append(name)
+    return dead
+
 # Similar to the process naming system above, we define a global mutex system
 # for critical sections, based just around file locks.
 @contextmanager
@@ -20,7 +20,9 @@ import logging
 import os
 import random
 import signal
+import sqlite3
 import stat
+import threading
 import time
 from abc import ABCMeta
 from struct import pack, unpack
@@ -31,10 +33,12 @@ import pytest
 from toil.common import Toil
 from toil.fileStores import FileID
 from toil.fileStores.cachingFileStore import (CacheUnbalancedError,
+                                              CachingFileStore,
                                               IllegalDeletionCacheError)
 from toil.job import Job
 from toil.jobStores.abstractJobStore import NoSuchFileException
 from toil.leader import FailedJobsException
+from toil.lib.threading import get_process_name
 from toil.realtimeLogger import RealtimeLogger
 from toil.test import ToilTest, needs_aws_ec2, needs_google, slow
 
@@ -1269,6 +1273,314 @@ class hidden:
             else:
                 raise RuntimeError("Managed to read a non-existent file")
 
+        def testLRUEviction(self):
+            """
+            Test that the least recently used file is the one evicted.
+            """
+            self.options.retryCount = 0
+            A = Job.wrapJobFn(self._evictionOrderFn)
+            Job.Runner.startToil(A, self.options)
+
+        def testSampleEviction(self):
+            """
+            Test that evicting from a sample of the cached files evicts the
+            least recently used file in the sample, and falls back to the
+            least recently used files overall when the sample isn't enough.
+            """
+            self.options.retryCount = 0
+            self.options.cacheEvictionPolicy = 'sample'
+            A = Job.wrapJobFn(self._sampleEvictionFn)
+            Job.Runner.startToil(A, self.options)
+
+        @staticmethod
+        def _cacheFilesForEviction(job, count):
+            """
+            Cache the given number of 1 KiB files, used one after the other
+            with nothing referencing them, and then use the first one again.
+
+            :return: The IDs of the files, in the order they were written.
+            """
+            work_dir = job.fileStore.getLocalTempDir()
+            fileIDs = []
+            for i in range(count):
+                with open(os.path.join(work_dir, str(uuid4())), 'wb') as localFile:
+                    localFile.write(os.urandom(1024))
+                fileIDs.append(job.fileStore.writeGlobalFile(localFile.name))
+                # Make sure the files are used at different times
+                time.sleep(0.1)
+            # Get the files into the cache with nothing referencing them
+            job.fileStore._finishQueuedUploads()
+            job.fileStore._executePendingUploads(job.fileStore.con, job.fileStore.cur)
+            for fileID in fileIDs:
+                job.fileStore.deleteLocalFile(fileID)
+            # Use the oldest file again
+            job.fileStore.readGlobalFile(fileIDs[0])
+            job.fileStore.deleteLocalFile(fileIDs[0])
+            return fileIDs
+
+        @staticmethod
+        def _evictionOrderFn(job):
+            """
+            Cache three files, use the first one again, and then evict one file
+            with the default policy, which should be LRU.
+            """
+            assert job.fileStore.evictionPolicy == 'lru', job.fileStore.evictionPolicy
+            fileIDs = hidden.AbstractCachingFileStoreTest._cacheFilesForEviction(job, 3)
+
+            assert job.fileStore._tryToFreeUpSpace()
+            stillCached = [job.fileStore.fileIsCached(fileID) for fileID in fileIDs]
+            assert stillCached == [True, False, True], stillCached
+
+        @staticmethod
+        def _sampleEvictionFn(job):
+            """
+            Cache four files, use the first one again, and then evict with
+            samples starting at chosen points in the cache.
+            """
+            fileStore = job.fileStore
+            assert fileStore.evictionPolicy == 'sample', fileStore.evictionPolicy
+            fileIDs = hidden.AbstractCachingFileStoreTest._cacheFilesForEviction(job, 4)
+
+            def sampleFrom(fileID):
+                # Make the sample start at the given file
+                rowid = fileStore.cur.execute('SELECT rowid FROM files WHERE id = ?', (fileID,)).fetchone()[0]
+                maxRowid = fileStore.cur.execute('SELECT MAX(rowid) FROM files').fetchone()[0]
+                return lambda: (rowid + 0.5) / (maxRowid + 1)
+
+            realRandom = random.random
+            try:
+                # A sample of just the newest file evicts it, even though it
+                # isn't the least recently used file overall.
+                random.random = sampleFrom(fileIDs[3])
+                assert fileStore._tryToFreeUpSpace()
+                stillCached = [fileStore.fileIsCached(fileID) for fileID in fileIDs]
+                assert stillCached == [True, True, True, False], stillCached
+
+                # If we are short by more than the sampled file, we make up the
+                # rest from the least recently used files.
+                maxSpace = fileStore.cur.execute("SELECT value FROM properties WHERE name = 'maxSpace'").fetchone()[0]
+                shortMaxSpace = maxSpace - fileStore.getCacheAvailable() - 1536
+                fileStore._write([("UPDATE properties SET value = ? WHERE name = 'maxSpace'", (shortMaxSpace,))])
+                try:
+                    random.random = sampleFrom(fileIDs[2])
+                    assert fileStore._tryToFreeUpSpace()
+                finally:
+                    fileStore._write([("UPDATE properties SET value = ? WHERE name = 'maxSpace'", (maxSpace,))])
+                stillCached = [fileStore.fileIsCached(fileID) for fileID in fileIDs]
+                assert stillCached == [True, False, False, False], stillCached
+            finally:
+                random.random = realRandom
+
+        def testRetriedBackgroundUpload(self):
+            """
+            Test that a file the background upload thread couldn't upload is
+            left to be uploaded again when the job commits.
+            """
+            self.options.retryCount = 0
+            self.options.disableChaining = True
+            A = Job.wrapJobFn(self._retriedBackgroundUploadFn)
+            Job.Runner.startToil(A, self.options)
+
+        @staticmethod
+        def _retriedBackgroundUploadFn(job):
+            """
+            Make the background upload of a file fail, and check that it is
+            put back to be uploaded, and then uploaded at commit.
+            """
+            fileStore = job.fileStore
+            jobStore = fileStore.jobStore
+
+            def failingUpdateFile(fileID, localFilePath):
+                raise RuntimeError('Upload failed')
+
+            data = os.urandom(1024)
+            with open(os.path.join(fileStore.getLocalTempDir(), str(uuid4())), 'wb') as localFile:
+                localFile.write(data)
+
+            jobStore.update_file = failingUpdateFile
+            try:
+                fileID = fileStore.writeGlobalFile(localFile.name)
+                # The thread copes with the failed upload itself.
+                fileStore._finishQueuedUploads()
+            finally:
+                del jobStore.update_file
+
+            state = fileStore.cur.execute('SELECT state FROM files WHERE id = ?', (fileID,)).fetchone()[0]
+            assert state == 'uploadable', state
+
+            # Committing this job has to upload the file for the child to see it.
+            job.addChildJobFn(hidden.AbstractCachingFileStoreTest._checkJobStoreFileFn, fileID, data)
+
+        @staticmethod
+        def _checkJobStoreFileFn(job, fileID, data):
+            """
+            Make sure the job store has the given data for the given file.
+            """
+            with job.fileStore.jobStore.read_file_stream(fileID) as stream:
+                assert stream.read() == data
+
+        def testFailedBackgroundUpload(self):
+            """
+            Test that if the background upload thread dies, the error is raised
+            when uploads are finished, and the file it was holding still gets
+            uploaded.
+            """
+            self.options.retryCount = 0
+            A = Job.wrapJobFn(self._failedBackgroundUploadFn)
+            Job.Runner.startToil(A, self.options)
+
+        @staticmethod
+        def _failedBackgroundUploadFn(job):
+            """
+            Make the background upload fail, and then the database write that
+            would put the file back, and make sure we recover at commit time.
+            """
+            fileStore = job.fileStore
+            jobStore = fileStore.jobStore
+            jobThread = threading.current_thread()
+            uploadFailed = threading.Event()
+
+            def failingUpdateFile(fileID, localFilePath):
+                uploadFailed.set()
+                raise RuntimeError('Upload failed')
+
+            realStaticWrite = fileStore._staticWrite
+            def failingStaticWrite(con, cur, operations):
+                if uploadFailed.is_set() and threading.current_thread() is not jobThread:
+                    raise sqlite3.OperationalError('database or disk is full')
+                return realStaticWrite(con, cur, operations)
+
+            data = os.urandom(1024)
+            with open(os.path.join(fileStore.getLocalTempDir(), str(uuid4())), 'wb') as localFile:
+                localFile.write(data)
+
+            jobStore.update_file = failingUpdateFile
+            fileStore._staticWrite = failingStaticWrite
+            try:
+                fileID = fileStore.writeGlobalFile(localFile.name)
+                try:
+                    fileStore._finishQueuedUploads()
+                except sqlite3.OperationalError:
+                    pass
+                else:
+                    raise AssertionError('Background upload failure was not reported')
+            finally:
+                del jobStore.update_file
+                del fileStore._staticWrite
+
+            state = fileStore.cur.execute('SELECT state FROM files WHERE id = ?', (fileID,)).fetchone()[0]
+            assert state == 'uploading', state
+
+            fileStore._executePendingUploads(fileStore.con, fileStore.cur)
+            state = fileStore.cur.execute('SELECT state FROM files WHERE id = ?', (fileID,)).fetchone()[0]
+            assert state == 'cached', state
+            with jobStore.read_file_stream(fileID) as stream:
+                assert stream.read() == data
+
+        def testCacheTotals(self):
+            """
+            Test that the space totals the cache keeps up to date always match
+            what is actually in the cache database.
+            """
+            self.options.retryCount = 0
+            workdir = self._createTempDir(purpose='nonLocalDir')
+            A = Job.wrapJobFn(self._cacheTotalsFn, nonLocalDir=workdir)
+            Job.Runner.startToil(A, self.options)
+
+        @staticmethod
+        def _checkCacheTotals(fileStore):
+            """
+            Make sure the cache's running space totals agree with adding up the
+            files, jobs, and references from scratch.
+            """
+            cur = fileStore.cur
+            totals = dict(cur.execute("SELECT name, value FROM properties WHERE name IN "
+                                      "('cachedBytes', 'jobDiskBytes', 'immutableRefBytes')").fetchall())
+            expected = {
+                'cachedBytes': cur.execute('SELECT TOTAL(size) FROM files').fetchone()[0],
+                'jobDiskBytes': cur.execute('SELECT TOTAL(disk) FROM jobs').fetchone()[0],
+                'immutableRefBytes': cur.execute('SELECT TOTAL(files.size) FROM refs INNER JOIN files ON '
+                                                 'refs.file_id = files.id WHERE refs.state = ?',
+                                                 ('immutable',)).fetchone()[0]
+            }
+            assert totals == expected, (totals, expected)
+
+        @staticmethod
+        def _cacheTotalsFn(job, nonLocalDir):
+            """
+            Write, read, give away, delete, and evict files, and remove a job,
+            checking the cache's space totals after each step.
+            """
+            fileStore = job.fileStore
+            check = hidden.AbstractCachingFileStoreTest._checkCacheTotals
+            work_dir = fileStore.getLocalTempDir()
+            check(fileStore)
+
+            def writeFile(directory):
+                with open(os.path.join(directory, str(uuid4())), 'wb') as localFile:
+                    localFile.write(os.urandom(1024))
+                return fileStore.writeGlobalFile(localFile.name)
+
+            # Write files into the cache, and one that can't go in it
+            cachedIDs = [writeFile(work_dir) for i in range(3)]
+            nonLocalID = writeFile(nonLocalDir)
+            check(fileStore)
+            fileStore._finishQueuedUploads()
+            fileStore._executePendingUploads(fileStore.con, fileStore.cur)
+            check(fileStore)
+
+            # Read immutably and mutably
+            fileStore.readGlobalFile(cachedIDs[0])
+            check(fileStore)
+            fileStore.readGlobalFile(cachedIDs[0], mutable=True)
+            check(fileStore)
+            fileStore.deleteLocalFile(cachedIDs[0])
+            check(fileStore)
+
+            # Read a file that isn't cached mutably when there isn't room for
+            # two copies, so the downloaded copy is given away.
+            fileStore.deleteLocalFile(cachedIDs[1])
+            fileStore._write([('UPDATE files SET state = ?, owner = ? WHERE id = ?',
+                               ('deleting', get_process_name(fileStore.coordination_dir), cachedIDs[1]))])
+            fileStore._executePendingDeletions(fileStore.coordination_dir, fileStore.con, fileStore.cur)
+            check(fileStore)
+            maxSpace = fileStore.cur.execute("SELECT value FROM properties WHERE name = 'maxSpace'").fetchone()[0]
+            realFulfill = fileStore._fulfillCopyingReference
+            def fulfillWithoutSpace(*args):
+                # Even if caching is free, this leaves no room.
+                fileStore._write([("UPDATE properties SET value = ? WHERE name = 'maxSpace'", (-1,))])
+                try:
+                    realFulfill(*args)
+                finally:
+                    fileStore._write([("UPDATE properties SET value = ? WHERE name = 'maxSpace'", (maxSpace,))])
+            fileStore._fulfillCopyingReference = fulfillWithoutSpace
+            try:
+                givenAway = fileStore.readGlobalFile(cachedIDs[1], mutable=True)
+            finally:
+                del fileStore._fulfillCopyingReference
+            assert os.path.exists(givenAway)
+            assert not fileStore.fileIsCached(cachedIDs[1])
+            check(fileStore)
+
+            # Remove a job that still holds a reference
+            fakeJobID = str(uuid4())
+            fakeJobDir = fileStore.getLocalTempDir()
+            fileStore._write([('INSERT INTO jobs VALUES (?, ?, ?, ?)',
+                               (fakeJobID, fakeJobDir, 4096, get_process_name(fileStore.coordination_dir))),
+                              ('INSERT INTO refs VALUES (?, ?, ?, ?)',
+                               (os.path.join(fakeJobDir, 'ref'), cachedIDs[2], fakeJobID, 'immutable'))])
+            check(fileStore)
+            CachingFileStore._removeJob(fileStore.con, fileStore.cur, fakeJobID)
+            check(fileStore)
+
+            # Evict and delete
+            fileStore.deleteLocalFile(cachedIDs[2])
+            assert fileStore._tryToFreeUpSpace()
+            check(fileStore)
+            fileStore.deleteGlobalFile(cachedIDs[0])
+            fileStore.deleteGlobalFile(nonLocalID)
+            check(fileStore)
+
         def testSimultaneousReadsUncachedStream(self):
             """
             Test many simultaneous read attempts on a file created via a stream
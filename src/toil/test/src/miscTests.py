@@ -15,13 +15,18 @@ import inspect
 import logging
 import os
 import random
+import stat
 import sys
 import tempfile
 from uuid import uuid4
 
 from toil.common import getNodeID
 from toil.lib.exceptions import panic, raise_
-from toil.lib.io import AtomicFileCreate, atomic_install, atomic_tmp_file
+from toil.lib.io import (AtomicFileCreate,
+                         atomic_copy,
+                         atomic_install,
+                         atomic_tmp_file,
+                         try_reflink)
 from toil.lib.misc import CalledProcessErrorStderr, call_command
 from toil.test import ToilTest, slow
 
@@ -130,6 +135,28 @@ class MiscTests(ToilTest):
             self.assertEqual(str(ex), "stop!")
         self.assertFalse(os.path.exists(outf))
 
+    def test_atomic_copy(self):
+        src = self._get_test_out_file(".src")
+        self._write_test_file(src)
+        os.chmod(src, os.stat(src).st_mode | stat.S_IXUSR)
+        dest = self._get_test_out_file(".dest")
+        atomic_copy(src, dest)
+        with open(src) as src_fh, open(dest) as dest_fh:
+            self.assertEqual(src_fh.read(), dest_fh.read())
+        self.assertTrue(os.stat(dest).st_mode & stat.S_IXUSR)
+
+    def test_try_reflink(self):
+        src = self._get_test_out_file(".src")
+        self._write_test_file(src)
+        dest = self._get_test_out_file(".dest")
+        if try_reflink(src, dest):
+            # The file system supports clones, so we should have one.
+            with open(src) as src_fh, open(dest) as dest_fh:
+                self.assertEqual(src_fh.read(), dest_fh.read())
+        # Either way the source must be untouched.
+        with open(src) as src_fh:
+            self.assertEqual(src_fh.read(), self.id() + '\n')
+
     def test_call_command_ok(self):
         o = call_command(["echo", "Fred"])
         self.assertEqual("Fred\n", o)
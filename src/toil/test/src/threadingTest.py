@@ -6,7 +6,13 @@ import time
 import traceback
 from functools import partial
 
-from toil.lib.threading import LastProcessStandingArena, cpu_count, global_mutex
+from toil.lib.threading import (
+    LastProcessStandingArena,
+    cpu_count,
+    dead_process_names,
+    get_process_name,
+    global_mutex,
+)
 from toil.test import ToilTest
 
 log = logging.getLogger(__name__)
@@ -61,6 +67,21 @@ class ThreadingTest(ToilTest):
             for filename in os.listdir(scope):
                 assert not filename.startswith('precious'), f"File {filename} still exists"
 
+    def testDeadProcessNames(self):
+        scope = self._createTempDir()
+        # Get a name for ourselves, which must always count as alive.
+        me = get_process_name(scope)
+        # Make a name file that nobody holds a lock on.
+        with open(os.path.join(scope, 'abandoned'), 'w'):
+            pass
+
+        dead = dead_process_names(scope, [me, 'abandoned', 'missing'])
+        self.assertEqual(dead, ['abandoned', 'missing'])
+        # Polling the abandoned name cleans up its file.
+        self.assertFalse(os.path.exists(os.path.join(scope, 'abandoned')))
+        # With nobody to poll, we don't even look at the directory.
+        self.assertEqual(dead_process_names(os.path.join(scope, 'missing'), iter([])), [])
+
 def _testGlobalMutexOrderingTask(scope, mutex, number):
     try:
         # We will all fight over the potato